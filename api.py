@@ -1,8 +1,39 @@
-from typing import Dict, Optional, Union
+from typing import Dict, Iterator, Optional, Union
+import wave
 
 import numpy as np
 
-from .generation import codec_decode, generate_coarse, generate_fine, generate_text_semantic
+from .chunking import chunk_text
+from .generation import (
+    COARSE_RATE_HZ,
+    N_COARSE_CODEBOOKS,
+    N_FINE_CODEBOOKS,
+    SAMPLE_RATE,
+    _load_history_prompt,
+    codec_decode,
+    encode_texts_for_semantic,
+    generate_coarse,
+    generate_coarse_batch,
+    generate_coarse_stream,
+    generate_fine,
+    generate_fine_batch,
+    generate_text_semantic,
+    generate_text_semantic_batch,
+)
+from .render_cache import (
+    ENABLE_RENDER_CACHE,
+    load_render,
+    load_semantic,
+    render_key,
+    save_render,
+    save_semantic,
+    semantic_key,
+)
+
+# frames of already emitted audio that are decoded again in front of each streamed chunk
+STREAM_DECODE_CONTEXT_FRAMES = 16
+# coarse frames collected before a streamed chunk is refined, every chunk costs a fine model pass
+STREAM_MIN_CHUNK_FRAMES = 256
 
 
 def text_to_semantic(
@@ -10,6 +41,7 @@ def text_to_semantic(
     history_prompt: Optional[Union[Dict, str]] = None,
     temp: float = 0.7,
     silent: bool = False,
+    seed: Optional[int] = None,
 ):
     """Generate semantic array from text.
 
@@ -18,17 +50,28 @@ def text_to_semantic(
         history_prompt: history choice for audio cloning
         temp: generation temperature (1.0 more diverse, 0.0 more conservative)
         silent: disable progress bar
+        seed: seed for sampling, the same inputs and seed give the same output. Seeded
+            outputs are served from and stored in the on-disk semantic cache.
 
     Returns:
         numpy semantic array to be fed into `semantic_to_waveform`
     """
+    cache_key = None
+    if seed is not None and ENABLE_RENDER_CACHE:
+        cache_key = semantic_key(text, history_prompt, temp, seed)
+        x_semantic = load_semantic(cache_key)
+        if x_semantic is not None:
+            return x_semantic
     x_semantic = generate_text_semantic(
         text,
         history_prompt=history_prompt,
         temp=temp,
         silent=silent,
-        use_kv_caching=True
+        use_kv_caching=True,
+        seed=seed,
     )
+    if cache_key is not None:
+        save_semantic(cache_key, x_semantic)
     return x_semantic
 
 
@@ -38,6 +81,7 @@ def semantic_to_waveform(
     temp: float = 0.7,
     silent: bool = False,
     output_full: bool = False,
+    seed: Optional[int] = None,
 ):
     """Generate audio array from semantic input.
 
@@ -47,6 +91,7 @@ def semantic_to_waveform(
         temp: generation temperature (1.0 more diverse, 0.0 more conservative)
         silent: disable progress bar
         output_full: return full generation to be used as a history prompt
+        seed: seed for sampling, the same inputs and seed give the same output
 
     Returns:
         numpy audio array at sample frequency 24khz
@@ -56,12 +101,14 @@ def semantic_to_waveform(
         history_prompt=history_prompt,
         temp=temp,
         silent=silent,
-        use_kv_caching=True
+        use_kv_caching=True,
+        seed=seed,
     )
     fine_tokens = generate_fine(
         coarse_tokens,
         history_prompt=history_prompt,
         temp=0.5,
+        seed=seed,
     )
     audio_arr = codec_decode(fine_tokens)
     if output_full:
@@ -90,6 +137,7 @@ def generate_audio(
     waveform_temp: float = 0.7,
     silent: bool = False,
     output_full: bool = False,
+    seed: Optional[int] = None,
 ):
     """Generate audio array from input text.
 
@@ -100,26 +148,304 @@ def generate_audio(
         waveform_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
         silent: disable progress bar
         output_full: return full generation to be used as a history prompt
+        seed: seed for sampling, the same inputs and seed give bit-identical audio. Seeded
+            renders are served from and stored in the on-disk render cache.
 
     Returns:
         numpy audio array at sample frequency 24khz
     """
+    cache_key = None
+    if seed is not None and ENABLE_RENDER_CACHE:
+        cache_key = render_key(text, history_prompt, text_temp, waveform_temp, seed)
+        cached = load_render(cache_key)
+        if cached is not None:
+            full_generation, audio_arr = cached
+            if output_full:
+                return full_generation, audio_arr
+            return audio_arr
     semantic_tokens = text_to_semantic(
         text,
         history_prompt=history_prompt,
         temp=text_temp,
         silent=silent,
+        seed=seed,
     )
     out = semantic_to_waveform(
         semantic_tokens,
         history_prompt=history_prompt,
         temp=waveform_temp,
         silent=silent,
-        output_full=output_full,
+        output_full=output_full or cache_key is not None,
+        seed=seed,
     )
+    if cache_key is not None:
+        save_render(cache_key, *out)
+        if not output_full:
+            out = out[1]
     if output_full:
         full_generation, audio_arr = out
         return full_generation, audio_arr
     else:
         audio_arr = out
     return audio_arr
+
+
+def generate_audio_stream(
+    text: str,
+    history_prompt: Optional[Union[Dict, str]] = None,
+    text_temp: float = 0.7,
+    waveform_temp: float = 0.7,
+    silent: bool = False,
+    sliding_window_len: int = 60,
+    crossfade_s: float = 0.02,
+    seed: Optional[int] = None,
+    min_chunk_frames: int = STREAM_MIN_CHUNK_FRAMES,
+) -> Iterator[np.ndarray]:
+    """Generate audio from input text, yielding chunks as soon as they are decoded.
+
+    The semantic tokens are generated up front, then the coarse sliding windows are collected
+    until they hold `min_chunk_frames` frames, refined by the fine model and decoded right away.
+    Each chunk is decoded together with a few frames of the previous one and crossfaded into it
+    to hide the seams. Every chunk takes a full fine model pass, so smaller chunks start playing
+    sooner but cost more fine compute per sentence.
+
+    With `SUNO_OFFLOAD_CPU` the coarse model stays on the device for the whole call, next to the
+    fine and codec models, as the coarse generation is suspended rather than finished between
+    chunks. Offloading does not lower the peak device memory of this function.
+
+    Args:
+        text: text to be turned into audio
+        history_prompt: history choice for audio cloning
+        text_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        waveform_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        silent: disable progress bar
+        sliding_window_len: coarse steps generated per chunk (2 steps per audio frame)
+        crossfade_s: length of the crossfade between consecutive chunks in seconds
+        seed: seed for sampling, the same inputs and seed give the same audio
+        min_chunk_frames: coarse frames (75 per second) refined and decoded together, the last
+            chunk may be shorter
+
+    Yields:
+        float32 numpy audio chunks at sample frequency 24khz
+    """
+    samples_per_frame = int(SAMPLE_RATE / COARSE_RATE_HZ)
+    n_crossfade = int(crossfade_s * SAMPLE_RATE)
+    assert 0 < n_crossfade <= STREAM_DECODE_CONTEXT_FRAMES * samples_per_frame
+    assert min_chunk_frames > 0
+    semantic_tokens = text_to_semantic(
+        text,
+        history_prompt=history_prompt,
+        temp=text_temp,
+        silent=silent,
+        seed=seed,
+    )
+    if history_prompt is not None:
+        history_prompt = _load_history_prompt(history_prompt)
+        coarse_tokens = history_prompt["coarse_prompt"]
+        fine_tokens = history_prompt["fine_prompt"]
+    else:
+        coarse_tokens = np.zeros((N_COARSE_CODEBOOKS, 0), dtype=np.int32)
+        fine_tokens = np.zeros((N_FINE_CODEBOOKS, 0), dtype=np.int32)
+    n_history = fine_tokens.shape[-1]
+    tail = None
+    coarse_windows = generate_coarse_stream(
+        semantic_tokens,
+        history_prompt=history_prompt,
+        temp=waveform_temp,
+        silent=silent,
+        sliding_window_len=sliding_window_len,
+        use_kv_caching=True,
+        seed=seed,
+    )
+    for coarse_chunk in _collect_frames(coarse_windows, min_chunk_frames):
+        fine_history = None
+        if fine_tokens.shape[-1] > 0:
+            fine_history = {
+                "semantic_prompt": semantic_tokens,
+                "coarse_prompt": coarse_tokens,
+                "fine_prompt": fine_tokens,
+            }
+        fine_chunk = generate_fine(
+            coarse_chunk, history_prompt=fine_history, temp=0.5, seed=seed
+        )
+        n_decoded = fine_tokens.shape[-1] - n_history
+        n_context = min(n_decoded, STREAM_DECODE_CONTEXT_FRAMES)
+        coarse_tokens = np.hstack([coarse_tokens, coarse_chunk])
+        fine_tokens = np.hstack([fine_tokens, fine_chunk])
+        n_decode = n_context + fine_chunk.shape[-1]
+        chunk = codec_decode(fine_tokens[:, -n_decode:]).astype(np.float32)
+        if tail is not None:
+            # the start of this chunk overlaps the tail held back from the previous one
+            chunk = chunk[n_context * samples_per_frame - len(tail) :]
+            fade_in = np.linspace(0.0, 1.0, len(tail), dtype=np.float32)
+            chunk[: len(tail)] = tail * (1 - fade_in) + chunk[: len(tail)] * fade_in
+        n_tail = min(n_crossfade, len(chunk))
+        tail = chunk[len(chunk) - n_tail :].copy()
+        yield chunk[: len(chunk) - n_tail]
+    yield tail
+
+
+def _collect_frames(coarse_windows, min_frames):
+    # joins consecutive coarse windows until they hold at least `min_frames` frames
+    pending = []
+    n_pending = 0
+    for coarse_window in coarse_windows:
+        pending.append(coarse_window)
+        n_pending += coarse_window.shape[-1]
+        if n_pending >= min_frames:
+            yield np.hstack(pending)
+            pending = []
+            n_pending = 0
+    if len(pending) > 0:
+        yield np.hstack(pending)
+
+
+def _render_batch(texts, encoded_texts, history_prompt, text_temp, waveform_temp, seeds, silent):
+    """Render several texts with the batched stages, returns `(full_generation, audio_arr)`s."""
+    renders = [None] * len(texts)
+    cache_keys = [None] * len(texts)
+    if seeds is not None and ENABLE_RENDER_CACHE:
+        for i, (text, seed) in enumerate(zip(texts, seeds)):
+            cache_keys[i] = render_key(text, history_prompt, text_temp, waveform_temp, seed)
+            renders[i] = load_render(cache_keys[i])
+    todo = [i for i, render in enumerate(renders) if render is None]
+    if len(todo) == 0:
+        return renders
+    todo_seeds = None if seeds is None else [seeds[i] for i in todo]
+    semantic_tokens = generate_text_semantic_batch(
+        [texts[i] for i in todo],
+        history_prompts=history_prompt,
+        temp=text_temp,
+        silent=silent,
+        use_kv_caching=True,
+        seeds=todo_seeds,
+        encoded_texts=encoded_texts[todo],
+    )
+    coarse_tokens = generate_coarse_batch(
+        semantic_tokens,
+        history_prompts=history_prompt,
+        temp=waveform_temp,
+        silent=silent,
+        use_kv_caching=True,
+        seeds=todo_seeds,
+    )
+    fine_tokens = generate_fine_batch(
+        coarse_tokens, history_prompts=history_prompt, temp=0.5, seeds=todo_seeds
+    )
+    for i, x_semantic, x_coarse, x_fine in zip(todo, semantic_tokens, coarse_tokens, fine_tokens):
+        full_generation = {
+            "semantic_prompt": x_semantic,
+            "coarse_prompt": x_coarse,
+            "fine_prompt": x_fine,
+        }
+        renders[i] = full_generation, codec_decode(x_fine)
+        if cache_keys[i] is not None:
+            save_render(cache_keys[i], *renders[i])
+    return renders
+
+
+def _to_pcm16(audio_arr):
+    return (np.clip(audio_arr, -1.0, 1.0) * np.iinfo(np.int16).max).astype("<i2").tobytes()
+
+
+def generate_long_form(
+    text: str,
+    output_path: str,
+    history_prompt: Optional[Union[Dict, str]] = None,
+    text_temp: float = 0.7,
+    waveform_temp: float = 0.7,
+    silent: bool = False,
+    voice_continuity: bool = False,
+    silence_s: float = 0.25,
+    batch_size: int = 8,
+    seed: Optional[int] = None,
+    n_workers: int = 0,
+):
+    """Generate audio for text of any length and write it to a 16 bit wav file as it goes.
+
+    The text is split with `chunk_text` into chunks sized to fit one generation. Without
+    `voice_continuity` the chunks are rendered `batch_size` at a time through the batched
+    stages. With it they are rendered one after the other, each using the full generation of
+    the previous chunk as its history prompt, which keeps the voice consistent across chunks.
+    With `n_workers` the chunks are instead rendered one by one in that many cpu processes, see
+    `parallel.generate_audio_parallel`, and `batch_size` is not used. Text that is empty or
+    only whitespace raises a ValueError before `output_path` is created.
+
+    Args:
+        text: text to be turned into audio
+        output_path: path of the wav file to write
+        history_prompt: history choice for audio cloning, of the first chunk with
+            `voice_continuity`
+        text_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        waveform_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        silent: disable progress bar
+        voice_continuity: condition every chunk on the previous one
+        silence_s: silence inserted between chunks in seconds
+        batch_size: chunks rendered together without `voice_continuity` or `n_workers`
+        seed: seed for sampling, chunk `i` is rendered with seed `seed + i`
+        n_workers: render in this many worker processes, 0 renders in this process
+
+    Returns:
+        number of audio samples written
+    """
+    assert batch_size > 0
+    assert n_workers == 0 or not voice_continuity, "chunks with continuity render in order"
+    chunks = chunk_text(text)
+    if len(chunks) == 0:
+        raise ValueError("text is empty, there is nothing to generate")
+    seeds = None if seed is None else [seed + i for i in range(len(chunks))]
+    silence = _to_pcm16(np.zeros(int(silence_s * SAMPLE_RATE), dtype=np.float32))
+    n_samples = 0
+    with wave.open(output_path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+
+        def write(audio_arr):
+            nonlocal n_samples
+            if n_samples > 0:
+                f.writeframes(silence)
+                n_samples += len(silence) // 2
+            f.writeframes(_to_pcm16(audio_arr))
+            n_samples += len(audio_arr)
+
+        if voice_continuity:
+            for i, chunk in enumerate(chunks):
+                history_prompt, audio_arr = generate_audio(
+                    chunk,
+                    history_prompt=history_prompt,
+                    text_temp=text_temp,
+                    waveform_temp=waveform_temp,
+                    silent=silent,
+                    output_full=True,
+                    seed=None if seeds is None else seeds[i],
+                )
+                write(audio_arr)
+        elif n_workers > 0:
+            # imported here, the parallel module itself builds on this one
+            from .parallel import generate_audio_parallel
+
+            for audio_arr in generate_audio_parallel(
+                chunks,
+                history_prompt=history_prompt,
+                text_temp=text_temp,
+                waveform_temp=waveform_temp,
+                seed=seed,
+                n_workers=n_workers,
+            ):
+                write(audio_arr)
+        else:
+            encoded_texts = encode_texts_for_semantic(chunks)
+            for start in range(0, len(chunks), batch_size):
+                end = start + batch_size
+                for _, audio_arr in _render_batch(
+                    chunks[start:end],
+                    encoded_texts[start:end],
+                    history_prompt,
+                    text_temp,
+                    waveform_temp,
+                    None if seeds is None else seeds[start:end],
+                    silent,
+                ):
+                    write(audio_arr)
+    return n_samples
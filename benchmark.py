@@ -0,0 +1,208 @@
+"""Micro-benchmarks for the generation hot loops.
+
+Run with `python -m bark.benchmark --help`. By default a randomly initialized GPT with the
+default config is used, so no checkpoint download is needed; pass `--checkpoint` to time the
+real text or coarse model instead. `--compile` adds the `torch.compile`d decode step
+(`SUNO_COMPILE_DECODE`). `--int8` compares the speed and the seeded generations of the int8
+quantized checkpoint (`SUNO_QUANTIZE=int8`) against the float one on the cpu, on the fixed
+`QUALITY_SENTENCES`.
+"""
+import argparse
+import contextlib
+import copy
+import time
+
+import torch
+
+from .generation import (
+    QUANTIZE,
+    _grab_best_device,
+    _inference_mode,
+    generate_coarse,
+    generate_text_semantic,
+    load_model,
+    models,
+)
+from .model import GPT, GPTConfig, KVCache
+from .quantization import quantize_int8
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def bench_decode_steps(
+    model, n_prefix=257, n_steps=256, static=True, n_warmup=8, compiled=False
+):
+    """Time single token decode steps after a `n_prefix` prefill, returns seconds per step.
+
+    `static=False` runs the previous loop: tuple kv caches and token sequence grown with
+    `torch.cat` on every step. `static=True` runs the current one: a preallocated `KVCache`
+    and token buffer written in place. `compiled=True` runs the static loop through the
+    `torch.compile`d `GPT.decode_step`, compiled during the warmup steps.
+    """
+    device = next(model.parameters()).device
+    vocab_size = model.config.output_vocab_size
+    assert n_prefix + n_steps + n_warmup <= model.config.block_size
+    assert static or not compiled
+    step = torch.compile(model.decode_step, dynamic=False) if compiled else None
+    with _inference_mode():
+        x = torch.randint(0, vocab_size, (1, n_prefix), device=device)
+        if static:
+            kv_cache = KVCache(model.config)
+            x_len = x.shape[1]
+            x = torch.nn.functional.pad(x, (0, n_steps + n_warmup))
+            _, kv_cache = model(x[:, :x_len], use_cache=True, past_kv=kv_cache)
+        else:
+            _, kv_cache = model(x, use_cache=True)
+        for n in range(n_warmup + n_steps):
+            if n == n_warmup:
+                _sync(device)
+                t0 = time.perf_counter()
+            if compiled:
+                pos = torch.tensor([kv_cache.length], device=device)
+                logits = step(x[:, x_len - 1 : x_len], kv_cache.k, kv_cache.v, pos)
+                kv_cache.length += 1
+                x[:, x_len] = torch.argmax(logits[:, 0], dim=-1)
+                x_len += 1
+            elif static:
+                logits, kv_cache = model(
+                    x[:, x_len - 1 : x_len], use_cache=True, past_kv=kv_cache
+                )
+                x[:, x_len] = torch.argmax(logits[:, 0], dim=-1)
+                x_len += 1
+            else:
+                logits, kv_cache = model(x[:, [-1]], use_cache=True, past_kv=kv_cache)
+                x = torch.cat((x, torch.argmax(logits[:, 0], dim=-1)[None]), dim=1)
+        _sync(device)
+    return (time.perf_counter() - t0) / n_steps
+
+
+# fixed sentences the int8 models are compared on against the float ones
+QUALITY_SENTENCES = [
+    "Hello, my name is Suno. And, uh, I like pizza.",
+    "The quick brown fox jumps over the lazy dog.",
+    "It was the best of times, it was the worst of times.",
+    "Please remember to bring your umbrella, it might rain later today.",
+]
+
+
+@contextlib.contextmanager
+def _swapped_model(model_type, model):
+    # the generation functions read the loaded models from `generation.models`
+    loaded = models[model_type]
+    models[model_type] = {**loaded, "model": model} if model_type == "text" else model
+    try:
+        yield
+    finally:
+        models[model_type] = loaded
+
+
+def compare_generations(model_type, model, other, sentences=QUALITY_SENTENCES, seed=0):
+    """Run the seeded generation of `model_type` on `sentences` with `model` and with `other`.
+
+    Sentence `i` is generated with seed `seed + i` by both models, so they draw the same tokens
+    wherever their distributions agree. The coarse model is fed the semantic tokens of the loaded
+    text model. Returns the seconds `model` and `other` took and the fraction of `model`'s tokens
+    that `other` generated at the same position.
+    """
+    if model_type == "text":
+        inputs = sentences
+
+        def generate(x, seed):
+            return generate_text_semantic(x, silent=True, use_kv_caching=True, seed=seed)
+
+    else:
+        inputs = [
+            generate_text_semantic(text, silent=True, use_kv_caching=True, seed=seed + i)
+            for i, text in enumerate(sentences)
+        ]
+
+        def generate(x, seed):
+            return generate_coarse(x, silent=True, use_kv_caching=True, seed=seed)
+
+    seconds = []
+    outputs = []
+    for m in (model, other):
+        with _swapped_model(model_type, m):
+            t0 = time.perf_counter()
+            outputs.append([generate(x, seed + i) for i, x in enumerate(inputs)])
+            seconds.append(time.perf_counter() - t0)
+    n_same = 0
+    n_total = 0
+    for expected, actual in zip(*outputs):
+        n = min(expected.shape[-1], actual.shape[-1])
+        n_same += int((expected[..., :n] == actual[..., :n]).sum())
+        n_total += expected.size
+    return seconds[0], seconds[1], n_same / n_total
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--checkpoint",
+        choices=["text", "coarse"],
+        default=None,
+        help="time a real model instead of a randomly initialized one",
+    )
+    parser.add_argument("--use_small", action="store_true", help="use the small checkpoint")
+    parser.add_argument("--use_gpu", action="store_true", help="run on the best available device")
+    parser.add_argument("--n_prefix", type=int, default=257, help="prefill length")
+    parser.add_argument("--n_steps", type=int, default=256, help="timed decode steps")
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="compare the int8 quantized checkpoint against the float one, on the cpu",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the compared generations")
+    parser.add_argument(
+        "--compile", action="store_true", help="also time the torch.compile'd decode step"
+    )
+    args = parser.parse_args()
+    if args.int8 and args.use_gpu:
+        parser.error("int8 quantization runs on the cpu only, drop --use_gpu")
+    if args.int8 and QUANTIZE is not None:
+        parser.error("unset SUNO_QUANTIZE, --int8 compares against the float model")
+    if args.int8 and args.checkpoint is None:
+        parser.error("--int8 compares the generations of a real model, pass --checkpoint")
+
+    if args.checkpoint is not None:
+        model = load_model(
+            use_gpu=args.use_gpu, use_small=args.use_small, model_type=args.checkpoint
+        )
+        if args.checkpoint == "text":
+            model = model["model"]
+    else:
+        model = GPT(GPTConfig()).eval().to(_grab_best_device(use_gpu=args.use_gpu))
+    if args.int8:
+        if args.checkpoint == "coarse":
+            # generates the semantic tokens the coarse models are compared on
+            load_model(use_gpu=False, use_small=args.use_small, model_type="text")
+        quantized = quantize_int8(copy.deepcopy(model))
+        for name, m in (("float32", model), ("int8", quantized)):
+            step_s = bench_decode_steps(m, n_prefix=args.n_prefix, n_steps=args.n_steps)
+            print(f"{name:>32}: {step_s * 1e3:.3f} ms/step")
+        float_s, int8_s, same = compare_generations(
+            args.checkpoint, model, quantized, seed=args.seed
+        )
+        n_sentences = len(QUALITY_SENTENCES)
+        print(f"{'float32 generation':>32}: {float_s:.2f} s for {n_sentences} sentences")
+        print(f"{'int8 generation':>32}: {int8_s:.2f} s for {n_sentences} sentences")
+        print(f"{'same tokens as float32':>32}: {same:.1%}")
+        return
+    for static in (False, True):
+        step_s = bench_decode_steps(
+            model, n_prefix=args.n_prefix, n_steps=args.n_steps, static=static
+        )
+        name = "static kv cache + token buffer" if static else "torch.cat kv cache + tokens"
+        print(f"{name:>32}: {step_s * 1e3:.3f} ms/step")
+    if args.compile:
+        step_s = bench_decode_steps(
+            model, n_prefix=args.n_prefix, n_steps=args.n_steps, compiled=True
+        )
+        print(f"{'compiled decode step':>32}: {step_s * 1e3:.3f} ms/step")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import torch
+import torch.nn as nn
+
+from .model import LayerNorm
+
+# layers whose weights are stored in the storage dtype and cast up around their forward
+CASTED_LAYERS = (nn.Linear, nn.Embedding, nn.LayerNorm, LayerNorm)
+
+SUPPORTED_DTYPES = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+
+
+def _cast_in(module, args):
+    if module._storage_data is not None:
+        # a forward that raised left the weights in the compute dtype, they are put back next
+        return
+    module._storage_data = [param.data for param in module.parameters(recurse=False)]
+    for param in module.parameters(recurse=False):
+        param.data = param.data.to(module._compute_dtype)
+
+
+def _cast_out(module, args, output):
+    for param, data in zip(module.parameters(recurse=False), module._storage_data):
+        param.data = data
+    module._storage_data = None
+
+
+def apply_dtype_policy(model, storage_dtype, compute_dtype=torch.float32):
+    """Store the weights of `model` in `storage_dtype` and compute in `compute_dtype`, in place.
+
+    The weights of each of `CASTED_LAYERS` are cast to `compute_dtype` right before the layer
+    runs and dropped again afterwards, so only one layer at a time is held in the compute dtype.
+    That cast is paid on every forward, so equal dtypes, where the model is simply converted,
+    are the fast setting. Non float tensors, such as quantized linears, are left alone.
+    """
+    model.to(storage_dtype)
+    if storage_dtype == compute_dtype:
+        return model
+    for module in model.modules():
+        if not isinstance(module, CASTED_LAYERS):
+            continue
+        module._compute_dtype = compute_dtype
+        module._storage_data = None
+        module.register_forward_pre_hook(_cast_in)
+        module.register_forward_hook(_cast_out)
+    return model
@@ -0,0 +1,120 @@
+"""Split long text into chunks that fit one semantic generation.
+
+The text model sees at most 256 text tokens and generates at most 768 semantic tokens (about
+15 s of audio), anything longer is cut off. `chunk_text` splits at sentence ends, then at
+clause and word boundaries for sentences that are too long on their own, and merges short
+neighbours so every chunk fills the window as far as possible. The fit is a heuristic: token
+counts are exact, but the spoken length is estimated from the character count, so a chunk can
+still run past what the semantic model generates.
+"""
+import re
+
+from .generation import _get_tokenizer, _normalize_whitespace, _tokenize_batch
+
+# text tokens the semantic model reads per generation
+MAX_CHUNK_TOKENS = 256
+# spoken length targeted per chunk, below the ~15 s the semantic model can generate
+MAX_CHUNK_DURATION_S = 14.0
+# rough speaking rate used to estimate the spoken length of a piece of text
+CHARS_PER_SECOND = 14.0
+
+# a run of text up to and including its sentence end and any closing quotes or brackets
+_SENTENCE_RE = re.compile(r".+?(?:[.!?…]+[\"'”’)\]]*(?=\s|$)|[。！？]+|$)", re.DOTALL)
+_CLAUSE_END_RE = re.compile(r"(?<=[,;:、，；：])\s*")
+_WHITESPACE_RE = re.compile(r"\s+")
+# chinese and japanese characters and punctuation, written without spaces between them
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+def split_sentences(text):
+    """Split whitespace normalized `text` into sentences."""
+    text = _normalize_whitespace(text)
+    sentences = [match.group().strip() for match in _SENTENCE_RE.finditer(text)]
+    return [sentence for sentence in sentences if sentence]
+
+
+def _estimate_duration_s(text, chars_per_second):
+    return len(text) / chars_per_second
+
+
+def _join(chunk, piece):
+    if _CJK_RE.match(chunk[-1]) and _CJK_RE.match(piece[0]):
+        return f"{chunk}{piece}"
+    return f"{chunk} {piece}"
+
+
+def _split_to_fit(text, fits, max_chars):
+    # split an oversized sentence at clause ends first, then at spaces
+    for pattern in (_CLAUSE_END_RE, _WHITESPACE_RE):
+        parts = [part for part in pattern.split(text) if part]
+        if len(parts) > 1:
+            pieces = []
+            for part in parts:
+                pieces.extend([part] if fits(part) else _split_to_fit(part, fits, max_chars))
+            return pieces
+    # a run without clause ends or spaces, such as unpunctuated CJK text, is cut every
+    # `max_chars` characters, and halved further while the tokenizer still finds it too long
+    if len(text) <= 1:
+        return [text]
+    size = max_chars if len(text) > max_chars else (len(text) + 1) // 2
+    pieces = []
+    for start in range(0, len(text), size):
+        part = text[start : start + size]
+        pieces.extend([part] if fits(part) else _split_to_fit(part, fits, max_chars))
+    return pieces
+
+
+def chunk_text(
+    text,
+    tokenizer=None,
+    max_tokens=MAX_CHUNK_TOKENS,
+    max_duration_s=MAX_CHUNK_DURATION_S,
+    chars_per_second=CHARS_PER_SECOND,
+):
+    """Split `text` into chunks of at most `max_tokens` text tokens and ~`max_duration_s` speech.
+
+    Sentences are kept whole when they fit and consecutive sentences are merged greedily. Text
+    without clause ends or spaces is cut by character count. The duration is estimated at
+    `chars_per_second`, so it is a target rather than a bound. Without a `tokenizer` the one of
+    the text model is used.
+    """
+    assert 0 < max_tokens <= MAX_CHUNK_TOKENS
+    if tokenizer is None:
+        tokenizer = _get_tokenizer()
+
+    def n_tokens(pieces):
+        return [len(ids) for ids in _tokenize_batch(tokenizer, pieces)]
+
+    def fits(piece):
+        return (
+            n_tokens([piece])[0] <= max_tokens
+            and _estimate_duration_s(piece, chars_per_second) <= max_duration_s
+        )
+
+    max_chars = max(1, int(max_duration_s * chars_per_second))
+    sentences = split_sentences(text)
+    if len(sentences) == 0:
+        return []
+    pieces = []
+    for sentence, n in zip(sentences, n_tokens(sentences)):
+        if n <= max_tokens and _estimate_duration_s(sentence, chars_per_second) <= max_duration_s:
+            pieces.append(sentence)
+        else:
+            pieces.extend(_split_to_fit(sentence, fits, max_chars))
+    chunks = []
+    chunk, chunk_tokens = None, 0
+    for piece, n in zip(pieces, n_tokens(pieces)):
+        # wordpiece tokens do not cross whitespace or cjk characters, which the tokenizer splits
+        # one by one, so token counts add up when joining
+        if chunk is not None:
+            merged = _join(chunk, piece)
+            if (
+                chunk_tokens + n <= max_tokens
+                and _estimate_duration_s(merged, chars_per_second) <= max_duration_s
+            ):
+                chunk, chunk_tokens = merged, chunk_tokens + n
+                continue
+            chunks.append(chunk)
+        chunk, chunk_tokens = piece, n
+    chunks.append(chunk)
+    return chunks
@@ -1,14 +1,52 @@
 import argparse
 from typing import Dict, Optional, Union
 import os
+import sys
 
 from scipy.io.wavfile import write as write_wav
 from .api import generate_audio
-from .generation import SAMPLE_RATE
+from .generation import SAMPLE_RATE, convert_checkpoint
+from .quantization import SUPPORTED_QUANTIZATIONS
+
+
+def convert_cache_cli(argv):
+    """Commandline interface of `convert-cache`, preprocesses checkpoints for fast loading."""
+    parser = argparse.ArgumentParser(
+        prog="bark convert-cache", formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=["text", "coarse", "fine"],
+        choices=["text", "coarse", "fine"],
+        help="models to convert",
+    )
+    parser.add_argument(
+        "--use_small", default=False, type=bool, help="convert the small checkpoints"
+    )
+    parser.add_argument(
+        "--quantize",
+        default=None,
+        choices=list(SUPPORTED_QUANTIZATIONS),
+        help="store the weights quantized, as loaded with SUNO_QUANTIZE",
+    )
+
+    args = vars(parser.parse_args(argv))
+    try:
+        for model_type in args.get("models"):
+            path = convert_checkpoint(
+                model_type, use_small=args.get("use_small"), quantize=args.get("quantize")
+            )
+            print(f"Converted {model_type} model to: '{path}'")
+    except Exception as e:
+        print(f"Oops, an error occurred: {e}")
 
 
 def cli():
     """Commandline interface."""
+    if len(sys.argv) > 1 and sys.argv[1] == "convert-cache":
+        convert_cache_cli(sys.argv[2:])
+        return
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--text", type=str, help="text to be turned into audio")
     parser.add_argument(
@@ -36,6 +74,12 @@ def cli():
         type=float,
         help="generation temperature (1.0 more diverse, 0.0 more conservative)",
     )
+    parser.add_argument(
+        "--seed",
+        default=None,
+        type=int,
+        help="sampling seed, the same text, history prompt and seed give the same audio",
+    )
     parser.add_argument("--silent", default=False, type=bool, help="disable progress bar")
     parser.add_argument(
         "--output_full",
@@ -51,6 +95,7 @@ def cli():
     history_prompt: str = args.get("history_prompt")
     text_temp: float = args.get("text_temp")
     waveform_temp: float = args.get("waveform_temp")
+    seed: Optional[int] = args.get("seed")
     silent: bool = args.get("silent")
     output_full: bool = args.get("output_full")
 
@@ -63,6 +108,7 @@ def cli():
             waveform_temp=waveform_temp,
             silent=silent,
             output_full=output_full,
+            seed=seed,
         )
         output_file_path = os.path.join(output_dir, output_filename)
         write_wav(output_file_path, SAMPLE_RATE, generated_audio)
@@ -1,21 +1,31 @@
+import collections
 import contextlib
 import gc
+import hashlib
+import inspect
+import json
 import os
 import re
+import tempfile
+import threading
 
 from encodec import EncodecModel
 import funcy
 import logging
 import numpy as np
-from scipy.special import softmax
 import torch
 import torch.nn.functional as F
 import tqdm
-from transformers import BertTokenizer
+from transformers import BertTokenizer, BertTokenizerFast
 from huggingface_hub import hf_hub_download
 
-from .model import GPTConfig, GPT
+from .casting import SUPPORTED_DTYPES, apply_dtype_policy
+from .model import GPTConfig, GPT, KVCache
 from .model_fine import FineGPT, FineGPTConfig
+from .quantization import SUPPORTED_QUANTIZATIONS, int8_skeleton, quantize_int8
+from .residency import ModelResidency
+from .streaming import is_layer_streamed, stream_layers
+from .sampling import Sampler, make_generators
 
 if (
     torch.cuda.is_available() and
@@ -38,6 +48,10 @@ models = {}
 global models_devices
 models_devices = {}
 
+# checkpoint (key of `REMOTE_MODEL_PATHS`) each loaded model was built from
+global models_variants
+models_variants = {}
+
 
 CONTEXT_WINDOW_SIZE = 1024
 
@@ -83,6 +97,10 @@ CUR_PATH = os.path.dirname(os.path.abspath(__file__))
 
 default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache")
 CACHE_DIR = os.path.join(os.getenv("XDG_CACHE_HOME", default_cache_dir), "suno", "bark_v0")
+# checkpoints preprocessed by `convert_checkpoint`, listed in a manifest next to them
+CONVERTED_DIR = os.path.join(CACHE_DIR, "converted")
+# bump when the converted layout changes, older conversions are then ignored
+CONVERTED_FORMAT_VERSION = 1
 
 
 def _cast_bool_env_var(s):
@@ -92,6 +110,37 @@ def _cast_bool_env_var(s):
 USE_SMALL_MODELS = _cast_bool_env_var(os.environ.get("SUNO_USE_SMALL_MODELS", "False"))
 GLOBAL_ENABLE_MPS = _cast_bool_env_var(os.environ.get("SUNO_ENABLE_MPS", "False"))
 OFFLOAD_CPU = _cast_bool_env_var(os.environ.get("SUNO_OFFLOAD_CPU", "False"))
+# keep the transformer blocks of the GPT models in cpu memory and stream them to the device
+STREAM_LAYERS = _cast_bool_env_var(os.environ.get("SUNO_STREAM_LAYERS", "False"))
+# compile the single token decode step of the text and coarse models with `torch.compile`
+COMPILE_DECODE = _cast_bool_env_var(os.environ.get("SUNO_COMPILE_DECODE", "False"))
+COMPILE_MODE = os.environ.get("SUNO_COMPILE_MODE", "default")
+# megabytes of offloaded model weights kept on the device between calls, by default none, so
+# every offloaded model goes back to the cpu after its call, see `ModelResidency`
+OFFLOAD_BUDGET_MB = int(os.environ.get("SUNO_OFFLOAD_BUDGET_MB", "0"))
+
+# moves offloaded models to their device and back, see `residency_stats`
+model_residency = ModelResidency(budget_bytes=OFFLOAD_BUDGET_MB * 1024 * 1024)
+# number of semantic prefill kv caches kept on the device for reuse, off by default. They only
+# hit when the same text is rendered again with the same history prompt, such as unseeded
+# retakes of one sentence, seeded re-renders are served by the render cache
+SEMANTIC_PREFIX_CACHE_SIZE = int(os.environ.get("SUNO_SEMANTIC_PREFIX_CACHE_SIZE", "0"))
+# rust backed tokenizer, much faster when encoding many sentences in one call
+USE_FAST_TOKENIZER = _cast_bool_env_var(os.environ.get("SUNO_USE_FAST_TOKENIZER", "True"))
+PRELOAD_HISTORY_PROMPTS = _cast_bool_env_var(
+    os.environ.get("SUNO_PRELOAD_HISTORY_PROMPTS", "False")
+)
+# quantize the linears of models running on the cpu, "int8" or unset
+QUANTIZE = os.environ.get("SUNO_QUANTIZE") or None
+# dtype the weights of models running on the cpu are kept in, and the dtype they compute in.
+# Computing in the storage dtype casts nothing, so that is the default, except with
+# `SUNO_QUANTIZE`, whose int8 linears only take float32 inputs
+STORAGE_DTYPE = os.environ.get("SUNO_STORAGE_DTYPE") or None
+COMPUTE_DTYPE = os.environ.get("SUNO_COMPUTE_DTYPE") or (
+    "float32" if QUANTIZE is not None else STORAGE_DTYPE
+)
+# map checkpoints into memory and build the models around them instead of copying the weights
+MMAP_CHECKPOINTS = _cast_bool_env_var(os.environ.get("SUNO_MMAP_CHECKPOINTS", "True"))
 
 
 REMOTE_MODEL_PATHS = {
@@ -152,17 +201,28 @@ def _download(from_hf_path, file_name):
 
 
 class InferenceContext:
+    # the cudnn flag is process wide, so nested and concurrent contexts, such as the stage threads
+    # of the pipeline, only set it on the first enter and restore it on the last exit
+    _lock = threading.Lock()
+    _depth = 0
+    _cudnn_benchmark = None
+
     def __init__(self, benchmark=False):
         # we can't expect inputs to be the same length, so disable benchmarking by default
         self._chosen_cudnn_benchmark = benchmark
-        self._cudnn_benchmark = None
 
     def __enter__(self):
-        self._cudnn_benchmark = torch.backends.cudnn.benchmark
-        torch.backends.cudnn.benchmark = self._chosen_cudnn_benchmark
+        with InferenceContext._lock:
+            if InferenceContext._depth == 0:
+                InferenceContext._cudnn_benchmark = torch.backends.cudnn.benchmark
+                torch.backends.cudnn.benchmark = self._chosen_cudnn_benchmark
+            InferenceContext._depth += 1
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        torch.backends.cudnn.benchmark = self._cudnn_benchmark
+        with InferenceContext._lock:
+            InferenceContext._depth -= 1
+            if InferenceContext._depth == 0:
+                torch.backends.cudnn.benchmark = InferenceContext._cudnn_benchmark
 
 
 if torch.cuda.is_available():
@@ -182,44 +242,58 @@ def _clear_cuda_cache():
         torch.cuda.synchronize()
 
 
+def _is_offloaded(model_key):
+    # models with streamed layers are not offloaded whole, see `load_model`
+    return OFFLOAD_CPU and model_key in models_devices
+
+
 def clean_models(model_key=None):
     global models
     model_keys = [model_key] if model_key is not None else list(models.keys())
     for k in model_keys:
         if k in models:
             del models[k]
+        model_residency.forget(k)
+    if "text" in model_keys:
+        semantic_prefix_cache.clear()
     _clear_cuda_cache()
     gc.collect()
 
 
-def _load_model(ckpt_path, device, use_small=False, model_type="text"):
-    if model_type == "text":
-        ConfigClass = GPTConfig
-        ModelClass = GPT
-    elif model_type == "coarse":
-        ConfigClass = GPTConfig
-        ModelClass = GPT
-    elif model_type == "fine":
-        ConfigClass = FineGPTConfig
-        ModelClass = FineGPT
+def _model_classes(model_type):
+    if model_type in ("text", "coarse"):
+        return GPTConfig, GPT
+    if model_type == "fine":
+        return FineGPTConfig, FineGPT
+    raise NotImplementedError()
+
+
+def _read_checkpoint(ckpt_path, device, use_mmap):
+    if use_mmap:
+        # tensors stay backed by the file, pages are read in on first use
+        checkpoint = torch.load(ckpt_path, map_location="cpu", mmap=True)
     else:
-        raise NotImplementedError()
-    model_key = f"{model_type}_small" if use_small or USE_SMALL_MODELS else model_type
-    model_info = REMOTE_MODEL_PATHS[model_key]
-    if not os.path.exists(ckpt_path):
-        logger.info(f"{model_type} model not found, downloading into `{CACHE_DIR}`.")
-        _download(model_info["repo_id"], model_info["file_name"])
-    checkpoint = torch.load(ckpt_path, map_location=device)
+        checkpoint = torch.load(ckpt_path, map_location=device)
     # this is a hack
     model_args = checkpoint["model_args"]
     if "input_vocab_size" not in model_args:
         model_args["input_vocab_size"] = model_args["vocab_size"]
         model_args["output_vocab_size"] = model_args["vocab_size"]
         del model_args["vocab_size"]
-    gptconf = ConfigClass(**checkpoint["model_args"])
-    model = ModelClass(gptconf)
-    state_dict = checkpoint["model"]
-    # fixup checkpoint
+    return checkpoint
+
+
+def _build_model(model_type, model_args, on_meta):
+    ConfigClass, ModelClass = _model_classes(model_type)
+    gptconf = ConfigClass(**model_args)
+    if on_meta:
+        # no weights are allocated here, the checkpoint tensors are assigned later
+        with torch.device("meta"):
+            return ModelClass(gptconf)
+    return ModelClass(gptconf)
+
+
+def _fixup_state_dict(state_dict, model):
     unwanted_prefix = "_orig_mod."
     for k, v in list(state_dict.items()):
         if k.startswith(unwanted_prefix):
@@ -232,16 +306,50 @@ def _load_model(ckpt_path, device, use_small=False, model_type="text"):
         raise ValueError(f"extra keys found: {extra_keys}")
     if len(missing_keys) != 0:
         raise ValueError(f"missing keys: {missing_keys}")
-    model.load_state_dict(state_dict, strict=False)
+
+
+def _load_model(
+    ckpt_path, device, use_small=False, model_type="text", quantize=None, dtype_policy=None
+):
+    model_key = f"{model_type}_small" if use_small or USE_SMALL_MODELS else model_type
+    model_info = REMOTE_MODEL_PATHS[model_key]
+    converted_path = _converted_ckpt_path(_converted_key(model_key, quantize), ckpt_path)
+    if converted_path is None and quantize is not None:
+        # quantized once, later loads read the quantized weights from the converted cache
+        converted_path = convert_checkpoint(model_type, use_small=use_small, quantize=quantize)
+    if converted_path is not None:
+        logger.info(f"loading converted {model_type} model from `{converted_path}`.")
+        ckpt_path = converted_path
+    elif not os.path.exists(ckpt_path):
+        logger.info(f"{model_type} model not found, downloading into `{CACHE_DIR}`.")
+        _download(model_info["repo_id"], model_info["file_name"])
+    on_meta = _supports_mmap_load() and (MMAP_CHECKPOINTS or quantize is not None)
+    # quantized tensors are read eagerly, they are a quarter of the size anyway
+    checkpoint = _read_checkpoint(ckpt_path, device, on_meta and quantize is None)
+    model = _build_model(model_type, checkpoint["model_args"], on_meta)
+    if quantize is not None:
+        int8_skeleton(model)
+    state_dict = checkpoint["model"]
+    # converted checkpoints were fixed up and validated when they were written
+    if converted_path is None:
+        _fixup_state_dict(state_dict, model)
+    if on_meta:
+        model.load_state_dict(state_dict, strict=False, assign=True)
+        if isinstance(model, FineGPT):
+            model.tie_weights()
+    else:
+        model.load_state_dict(state_dict, strict=False)
     n_params = model.get_num_params()
     val_loss = checkpoint["best_val_loss"].item()
     logger.info(f"model loaded: {round(n_params/1e6,1)}M params, {round(val_loss,3)} loss")
     model.eval()
+    if dtype_policy is not None:
+        apply_dtype_policy(model, *dtype_policy)
     model.to(device)
     del checkpoint, state_dict
     _clear_cuda_cache()
     if model_type == "text":
-        tokenizer = BertTokenizer.from_pretrained("bert-base-multilingual-cased")
+        tokenizer = _load_tokenizer()
         return {
             "model": model,
             "tokenizer": tokenizer,
@@ -249,6 +357,178 @@ def _load_model(ckpt_path, device, use_small=False, model_type="text"):
     return model
 
 
+def _quantization_for(device):
+    """Quantization `SUNO_QUANTIZE` asks for, for a model computing on `device`."""
+    if QUANTIZE is None:
+        return None
+    if QUANTIZE not in SUPPORTED_QUANTIZATIONS:
+        raise ValueError(
+            f"unsupported `SUNO_QUANTIZE={QUANTIZE}`, choose from {SUPPORTED_QUANTIZATIONS}"
+        )
+    if device != "cpu":
+        logger.warning(f"`SUNO_QUANTIZE={QUANTIZE}` only applies to models on the cpu")
+        return None
+    return QUANTIZE
+
+
+def _dtype_policy_for(device):
+    """`(storage dtype, compute dtype)` set with `SUNO_STORAGE_DTYPE` for a model on `device`."""
+    if STORAGE_DTYPE is None:
+        return None
+    for name in (STORAGE_DTYPE, COMPUTE_DTYPE):
+        if name not in SUPPORTED_DTYPES:
+            raise ValueError(f"unsupported dtype `{name}`, choose from {list(SUPPORTED_DTYPES)}")
+    if device != "cpu":
+        logger.warning(f"`SUNO_STORAGE_DTYPE={STORAGE_DTYPE}` only applies to models on the cpu")
+        return None
+    if _quantization_for(device) is not None and COMPUTE_DTYPE != "float32":
+        raise ValueError(
+            f"`SUNO_QUANTIZE={QUANTIZE}` needs `SUNO_COMPUTE_DTYPE=float32`, "
+            "the int8 linears only take float32 inputs"
+        )
+    return SUPPORTED_DTYPES[STORAGE_DTYPE], SUPPORTED_DTYPES[COMPUTE_DTYPE]
+
+
+def _converted_key(model_key, quantize=None):
+    return model_key if quantize is None else f"{model_key}_{quantize}"
+
+
+def _manifest_path():
+    return os.path.join(CONVERTED_DIR, "manifest.json")
+
+
+def _read_manifest():
+    try:
+        with open(_manifest_path()) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if manifest.get("version") != CONVERTED_FORMAT_VERSION:
+        return {}
+    return manifest.get("models", {})
+
+
+def _source_stamp(ckpt_path):
+    stat = os.stat(ckpt_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _converted_ckpt_path(model_key, source_path):
+    """Converted checkpoint to load instead of `source_path`, or None if there is no usable one.
+
+    A conversion whose source checkpoint has since changed is ignored. One whose source has been
+    deleted is still used, so deployments can ship only the converted files.
+    """
+    entry = _read_manifest().get(model_key)
+    if entry is None:
+        return None
+    path = os.path.join(CONVERTED_DIR, entry["file_name"])
+    if not os.path.exists(path):
+        return None
+    if os.path.exists(source_path) and _source_stamp(source_path) != entry["source"]:
+        logger.warning(f"ignoring converted `{path}`, its source checkpoint changed")
+        return None
+    return path
+
+
+def convert_checkpoint(model_type="text", use_small=False, quantize=None):
+    """Write a ready to load copy of a checkpoint, which `load_model` then prefers.
+
+    The copy holds only the model weights with their keys fixed up, and the manifest in
+    `CONVERTED_DIR` records which source checkpoint it was made from.
+
+    Args:
+        model_type: one of "text", "coarse" or "fine"
+        use_small: convert the small checkpoint
+        quantize: store the weights quantized, one of `SUPPORTED_QUANTIZATIONS`, used by
+            `load_model` with `SUNO_QUANTIZE`
+
+    Returns:
+        path of the converted checkpoint
+    """
+    assert quantize is None or quantize in SUPPORTED_QUANTIZATIONS
+    model_key = _model_variant(model_type, use_small=use_small)
+    model_info = REMOTE_MODEL_PATHS[model_key]
+    source_path = _get_ckpt_path(model_type, use_small=use_small)
+    # a float conversion is a cleaner starting point for quantizing, and may be all there is
+    read_path = _converted_ckpt_path(model_key, source_path) if quantize is not None else None
+    if read_path is None:
+        read_path = source_path
+        if not os.path.exists(source_path):
+            logger.info(f"{model_type} model not found, downloading into `{CACHE_DIR}`.")
+            _download(model_info["repo_id"], model_info["file_name"])
+    use_mmap = _supports_mmap_load()
+    checkpoint = _read_checkpoint(read_path, "cpu", use_mmap)
+    model = _build_model(model_type, checkpoint["model_args"], use_mmap)
+    state_dict = checkpoint["model"]
+    _fixup_state_dict(state_dict, model)
+    if quantize is not None:
+        if use_mmap:
+            model.load_state_dict(state_dict, strict=False, assign=True)
+        else:
+            model.load_state_dict(state_dict, strict=False)
+        quantize_int8(model)
+        state_dict = model.state_dict()
+    # the causal mask is rebuilt by the model when it needs one
+    state_dict = {k: v for k, v in state_dict.items() if not k.endswith(".attn.bias")}
+    converted_key = _converted_key(model_key, quantize)
+    file_name = f"{converted_key}.pt"
+    path = os.path.join(CONVERTED_DIR, file_name)
+    converted = {
+        "model_args": checkpoint["model_args"],
+        "model": state_dict,
+        "best_val_loss": checkpoint["best_val_loss"],
+    }
+    _write_atomic(path, lambda f: torch.save(converted, f))
+    manifest = _read_manifest()
+    if read_path == source_path:
+        source = _source_stamp(source_path)
+    else:
+        # quantized from the float conversion, which may outlive its source checkpoint
+        source = manifest[model_key]["source"]
+    manifest[converted_key] = {
+        "file_name": file_name,
+        "source": source,
+        "dtype": "float32",
+        "quantize": quantize,
+    }
+    payload = {"version": CONVERTED_FORMAT_VERSION, "models": manifest}
+    _write_atomic(_manifest_path(), lambda f: f.write(json.dumps(payload, indent=2).encode()))
+    logger.info(f"converted `{read_path}` into `{path}`.")
+    return path
+
+
+def _write_atomic(path, write_fn):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write next to the target and rename, so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write_fn(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+@funcy.memoize
+def _supports_mmap_load():
+    # torch >= 2.1, which also always has flash attention, so no causal mask buffer is left on meta
+    return "mmap" in inspect.signature(torch.load).parameters and hasattr(
+        torch.nn.functional, "scaled_dot_product_attention"
+    )
+
+
+@funcy.memoize
+def _load_tokenizer():
+    if USE_FAST_TOKENIZER:
+        return BertTokenizerFast.from_pretrained("bert-base-multilingual-cased")
+    return BertTokenizer.from_pretrained("bert-base-multilingual-cased")
+
+
 def _load_codec_model(device):
     model = EncodecModel.encodec_model_24khz()
     model.set_target_bandwidth(6.0)
@@ -258,6 +538,19 @@ def _load_codec_model(device):
     return model
 
 
+def _model_variant(model_type, use_small=None):
+    """Key of `REMOTE_MODEL_PATHS` used for `model_type`.
+
+    With `use_small=None` this is the checkpoint currently loaded, or the one `preload_models`
+    would load by default.
+    """
+    if use_small is None:
+        if model_type in models_variants:
+            return models_variants[model_type]
+        use_small = False
+    return f"{model_type}_small" if use_small or USE_SMALL_MODELS else model_type
+
+
 def load_model(use_gpu=True, use_small=False, force_reload=False, model_type="text"):
     _load_model_f = funcy.partial(_load_model, model_type=model_type, use_small=use_small)
     if model_type not in ("text", "coarse", "fine"):
@@ -266,18 +559,29 @@ def load_model(use_gpu=True, use_small=False, force_reload=False, model_type="te
     global models_devices
     device = _grab_best_device(use_gpu=use_gpu)
     model_key = f"{model_type}"
-    if OFFLOAD_CPU:
+    # streamed models stay split between the cpu and the device, they are never moved whole
+    stream = STREAM_LAYERS and device != "cpu"
+    quantize = _quantization_for(device)
+    dtype_policy = _dtype_policy_for(device)
+    if OFFLOAD_CPU and not stream:
         models_devices[model_key] = device
         device = "cpu"
+    else:
+        models_devices.pop(model_key, None)
     if model_key not in models or force_reload:
         ckpt_path = _get_ckpt_path(model_type, use_small=use_small)
         clean_models(model_key=model_key)
-        model = _load_model_f(ckpt_path, device)
+        model = _load_model_f(
+            ckpt_path, "cpu" if stream else device, quantize=quantize, dtype_policy=dtype_policy
+        )
+        if stream:
+            stream_layers(model["model"] if model_type == "text" else model, device)
         models[model_key] = model
-    if model_type == "text":
-        models[model_key]["model"].to(device)
-    else:
-        models[model_key].to(device)
+        models_variants[model_key] = _model_variant(model_type, use_small=use_small)
+    model = models[model_key]["model"] if model_type == "text" else models[model_key]
+    if not is_layer_streamed(model):
+        model.to(device)
+    model_residency.forget(model_key)
     return models[model_key]
 
 
@@ -297,9 +601,24 @@ def load_codec_model(use_gpu=True, force_reload=False):
         model = _load_codec_model(device)
         models[model_key] = model
     models[model_key].to(device)
+    model_residency.forget(model_key)
     return models[model_key]
 
 
+def residency_stats():
+    """Hit, miss, eviction and bytes moved counters of the models moved with `SUNO_OFFLOAD_CPU`."""
+    return model_residency.stats()
+
+
+def offload_models():
+    """Move the idle models kept on their device by `SUNO_OFFLOAD_BUDGET_MB` back to the cpu.
+
+    Frees the device memory between jobs without unloading the models. Models in use are left
+    where they are.
+    """
+    model_residency.offload_all()
+
+
 def preload_models(
     text_use_gpu=True,
     text_use_small=False,
@@ -309,8 +628,12 @@ def preload_models(
     fine_use_small=False,
     codec_use_gpu=True,
     force_reload=False,
+    preload_history_prompts=PRELOAD_HISTORY_PROMPTS,
 ):
-    """Load all the necessary models for the pipeline."""
+    """Load all the necessary models for the pipeline.
+
+    With `preload_history_prompts` all bundled history prompts are loaded into memory as well.
+    """
     if _grab_best_device() == "cpu" and (
         text_use_gpu or coarse_use_gpu or fine_use_gpu or codec_use_gpu
     ):
@@ -328,6 +651,59 @@ def preload_models(
         model_type="fine", use_gpu=fine_use_gpu, use_small=fine_use_small, force_reload=force_reload
     )
     _ = load_codec_model(use_gpu=codec_use_gpu, force_reload=force_reload)
+    if COMPILE_DECODE:
+        _warm_up_decode_step("text", torch.int64, KVCache(models["text"]["model"].config))
+        coarse_max_len = 256 + 1 + 630 + 60  # window of `generate_coarse` defaults
+        _warm_up_decode_step(
+            "coarse", torch.int32, KVCache(models["coarse"].config, max_len=coarse_max_len)
+        )
+    if preload_history_prompts:
+        load_history_prompts()
+
+
+def _compiled_decode_step(model):
+    """`torch.compile`d `model.decode_step`, or None when decoding eagerly."""
+    if not COMPILE_DECODE or not hasattr(torch, "compile") or is_layer_streamed(model):
+        return None
+    step = getattr(model, "_compiled_decode_step", None)
+    if step is None:
+        step = torch.compile(model.decode_step, mode=COMPILE_MODE, dynamic=False)
+        model._compiled_decode_step = step
+    # False once compilation failed
+    return step or None
+
+
+def _decode_step(model, x_input, kv_cache):
+    """Logits of the `(b, 1)` token `x_input` after a filled `kv_cache`, which is advanced.
+
+    Uses the compiled step with `SUNO_COMPILE_DECODE`, falls back to `model.forward` otherwise or
+    when compilation fails.
+    """
+    step = _compiled_decode_step(model)
+    if step is not None:
+        try:
+            pos = torch.tensor([kv_cache.length], device=x_input.device)
+            logits = step(x_input, kv_cache.k, kv_cache.v, pos)
+        except Exception as e:
+            logger.warning(f"compiled decode step failed, decoding eagerly from now on: {e}")
+            model._compiled_decode_step = False
+        else:
+            kv_cache.length += 1
+            return logits, kv_cache
+    return model(x_input, use_cache=True, past_kv=kv_cache)
+
+
+def _warm_up_decode_step(model_key, token_dtype, kv_cache, n_steps=2):
+    # compiles for the device, dtypes and cache shape the generation loops use
+    model = models[model_key]["model"] if model_key == "text" else models[model_key]
+    if _is_offloaded(model_key) or _compiled_decode_step(model) is None:
+        return
+    device = next(model.parameters()).device
+    with _inference_mode():
+        x = torch.zeros((1, 1), dtype=token_dtype, device=device)
+        _, kv_cache = model(x, use_cache=True, past_kv=kv_cache)
+        for _ in range(n_steps):
+            _, kv_cache = _decode_step(model, x, kv_cache)
 
 
 ####
@@ -335,10 +711,6 @@ def preload_models(
 ####
 
 
-def _tokenize(tokenizer, text):
-    return tokenizer.encode(text, add_special_tokens=False)
-
-
 def _detokenize(tokenizer, enc_text):
     return tokenizer.decode(enc_text)
 
@@ -353,17 +725,84 @@ TEXT_PAD_TOKEN = 129_595
 SEMANTIC_INFER_TOKEN = 129_599
 
 
+# history prompt file path -> (file mtime, validated prompt), see `_load_history_prompt`
+history_prompt_registry = {}
+
+
+def _history_prompt_path(history_prompt_input):
+    if history_prompt_input.endswith(".npz"):
+        return os.path.abspath(history_prompt_input)
+    # make sure this works on non-ubuntu
+    history_prompt_input = os.path.join(*history_prompt_input.split("/"))
+    if history_prompt_input not in ALLOWED_PROMPTS:
+        raise ValueError("history prompt not found")
+    return os.path.join(CUR_PATH, "assets", "prompts", f"{history_prompt_input}.npz")
+
+
+def _validate_history_prompt(history_prompt):
+    semantic_prompt = history_prompt["semantic_prompt"]
+    coarse_prompt = history_prompt["coarse_prompt"]
+    fine_prompt = history_prompt["fine_prompt"]
+    assert (
+        isinstance(semantic_prompt, np.ndarray)
+        and len(semantic_prompt.shape) == 1
+        and len(semantic_prompt) > 0
+        and semantic_prompt.min() >= 0
+        and semantic_prompt.max() <= SEMANTIC_VOCAB_SIZE - 1
+    )
+    assert (
+        isinstance(coarse_prompt, np.ndarray)
+        and len(coarse_prompt.shape) == 2
+        and coarse_prompt.shape[0] == N_COARSE_CODEBOOKS
+        and (coarse_prompt.shape[-1] == 0 or coarse_prompt.min() >= 0)
+        and (coarse_prompt.shape[-1] == 0 or coarse_prompt.max() <= CODEBOOK_SIZE - 1)
+    )
+    assert (
+        isinstance(fine_prompt, np.ndarray)
+        and len(fine_prompt.shape) == 2
+        and fine_prompt.shape[0] == N_FINE_CODEBOOKS
+        and (fine_prompt.shape[-1] == 0 or fine_prompt.min() >= 0)
+        and (fine_prompt.shape[-1] == 0 or fine_prompt.max() <= CODEBOOK_SIZE - 1)
+    )
+    # convert once to the dtypes the stages use, read only since every caller shares them
+    history_prompt = {
+        "semantic_prompt": semantic_prompt.astype(np.int64),
+        "coarse_prompt": coarse_prompt.astype(np.int32),
+        "fine_prompt": fine_prompt.astype(np.int32),
+    }
+    for arr in history_prompt.values():
+        arr.flags.writeable = False
+    return history_prompt
+
+
+def _load_history_prompt_file(path):
+    mtime = os.path.getmtime(path)
+    if path in history_prompt_registry and history_prompt_registry[path][0] == mtime:
+        return history_prompt_registry[path][1]
+    with np.load(path) as data:
+        history_prompt = _validate_history_prompt(data)
+    history_prompt_registry[path] = (mtime, history_prompt)
+    return history_prompt
+
+
+def load_history_prompts(history_prompts=None):
+    """Load, validate and keep in memory history prompts, by default all bundled ones.
+
+    Bundled prompts whose file is missing are skipped. Later calls with the same prompt are
+    served from memory.
+    """
+    if history_prompts is None:
+        history_prompts = [
+            prompt for prompt in sorted(ALLOWED_PROMPTS)
+            if os.path.exists(_history_prompt_path(prompt))
+        ]
+    for history_prompt in history_prompts:
+        _load_history_prompt(history_prompt)
+
+
 def _load_history_prompt(history_prompt_input):
-    if isinstance(history_prompt_input, str) and history_prompt_input.endswith(".npz"):
-        history_prompt = np.load(history_prompt_input)
-    elif isinstance(history_prompt_input, str):
-        # make sure this works on non-ubuntu
-        history_prompt_input = os.path.join(*history_prompt_input.split("/"))
-        if history_prompt_input not in ALLOWED_PROMPTS:
-            raise ValueError("history prompt not found")
-        history_prompt = np.load(
-            os.path.join(CUR_PATH, "assets", "prompts", f"{history_prompt_input}.npz")
-        )
+    if isinstance(history_prompt_input, str):
+        history_prompt = _load_history_prompt_file(_history_prompt_path(history_prompt_input))
     elif isinstance(history_prompt_input, dict):
         assert("semantic_prompt" in history_prompt_input)
         assert("coarse_prompt" in history_prompt_input)
@@ -374,6 +813,107 @@ def _load_history_prompt(history_prompt_input):
     return history_prompt
 
 
+def _get_tokenizer():
+    # the tokenizer of the loaded text model, or only the tokenizer when no model is loaded
+    if "text" in models:
+        return models["text"]["tokenizer"]
+    return _load_tokenizer()
+
+
+def _tokenize_batch(tokenizer, texts):
+    return tokenizer(list(texts), add_special_tokens=False)["input_ids"]
+
+
+def encode_texts_for_semantic(texts, tokenizer=None):
+    """Tokenize `texts` in one batched call into the `[N, 256]` text input of the semantic model.
+
+    Texts are whitespace normalized, offset into the text vocab, and cut or padded to 256
+    tokens. Without a `tokenizer` the one of the loaded text model is used, or only the
+    tokenizer is loaded, so a whole chapter can be encoded before any model is on the device.
+    """
+    if tokenizer is None:
+        tokenizer = _get_tokenizer()
+    texts = [_normalize_whitespace(text) for text in texts]
+    encoded_texts = np.full((len(texts), 256), TEXT_PAD_TOKEN, dtype=np.int64)
+    for row, ids in enumerate(_tokenize_batch(tokenizer, texts)):
+        if len(ids) > 256:
+            p = round((len(ids) - 256) / len(ids) * 100, 1)
+            logger.warning(f"warning, text too long, lopping of last {p}%")
+            ids = ids[:256]
+        encoded_texts[row, : len(ids)] = np.array(ids, dtype=np.int64) + TEXT_ENCODING_OFFSET
+    return encoded_texts
+
+
+def _encode_text_for_semantic(tokenizer, text):
+    return encode_texts_for_semantic([text], tokenizer=tokenizer)[0]
+
+
+def _load_semantic_history(history_prompt):
+    if history_prompt is None:
+        return np.array([SEMANTIC_PAD_TOKEN] * 256)
+    history_prompt = _load_history_prompt(history_prompt)
+    semantic_history = history_prompt["semantic_prompt"]
+    assert (
+        isinstance(semantic_history, np.ndarray)
+        and len(semantic_history.shape) == 1
+        and len(semantic_history) > 0
+        and semantic_history.min() >= 0
+        and semantic_history.max() <= SEMANTIC_VOCAB_SIZE - 1
+    )
+    semantic_history = semantic_history.astype(np.int64)
+    # lop off if history is too long, pad if needed
+    semantic_history = semantic_history[-256:]
+    semantic_history = np.pad(
+        semantic_history,
+        (0, 256 - len(semantic_history)),
+        constant_values=SEMANTIC_PAD_TOKEN,
+        mode="constant",
+    )
+    return semantic_history
+
+
+# (model, prefix tokens) hash -> (logits, kv_cache) of the semantic prefill, in lru order
+semantic_prefix_cache = collections.OrderedDict()
+
+
+def _semantic_prefix_key(model, x):
+    # text and history are summed into the same positions by `merge_context`, so the prefill
+    # can only be reused when both of them match
+    return (id(model), hashlib.sha1(x.cpu().numpy().tobytes()).hexdigest())
+
+
+def _get_semantic_prefix(key):
+    if key not in semantic_prefix_cache:
+        return None
+    semantic_prefix_cache.move_to_end(key)
+    logits, kv_cache = semantic_prefix_cache[key]
+    # sampling may write into the logits, the kv tensors are only ever read
+    return logits.clone(), kv_cache
+
+
+def _put_semantic_prefix(key, logits, kv_cache):
+    semantic_prefix_cache[key] = (logits.clone(), kv_cache)
+    while len(semantic_prefix_cache) > SEMANTIC_PREFIX_CACHE_SIZE:
+        semantic_prefix_cache.popitem(last=False)
+
+
+def _select_kv_rows(kv_cache, rows):
+    """Keep only `rows` (index tensor or bool mask over the batch dim) of a kv cache."""
+    if kv_cache is None:
+        return None
+    if isinstance(kv_cache, KVCache):
+        return kv_cache.select_rows(rows)
+    return tuple((k[rows], v[rows]) for k, v in kv_cache)
+
+
+def _eos_rows(item_next, probs, min_eos_p):
+    """Rows that sampled eos (the last column of `probs`) or whose eos probability is too high."""
+    is_eos = item_next[:, 0] == probs.shape[-1] - 1
+    if min_eos_p is not None:
+        is_eos |= probs[:, -1] >= min_eos_p
+    return is_eos
+
+
 def generate_text_semantic(
     text,
     history_prompt=None,
@@ -385,23 +925,17 @@ def generate_text_semantic(
     max_gen_duration_s=None,
     allow_early_stop=True,
     use_kv_caching=False,
+    seed=None,
 ):
-    """Generate semantic tokens from text."""
+    """Generate semantic tokens from text.
+
+    With a `seed` the sampling draws from its own generator, so the same inputs and seed always
+    give the same tokens regardless of the global torch RNG state.
+    """
     assert isinstance(text, str)
     text = _normalize_whitespace(text)
     assert len(text.strip()) > 0
-    if history_prompt is not None:
-        history_prompt = _load_history_prompt(history_prompt)
-        semantic_history = history_prompt["semantic_prompt"]
-        assert (
-            isinstance(semantic_history, np.ndarray)
-            and len(semantic_history.shape) == 1
-            and len(semantic_history) > 0
-            and semantic_history.min() >= 0
-            and semantic_history.max() <= SEMANTIC_VOCAB_SIZE - 1
-        )
-    else:
-        semantic_history = None
+    semantic_history = _load_semantic_history(history_prompt)
     # load models if not yet exist
     global models
     global models_devices
@@ -410,108 +944,204 @@ def generate_text_semantic(
     model_container = models["text"]
     model = model_container["model"]
     tokenizer = model_container["tokenizer"]
-    encoded_text = np.array(_tokenize(tokenizer, text)) + TEXT_ENCODING_OFFSET
-    if OFFLOAD_CPU:
-        model.to(models_devices["text"])
-    device = next(model.parameters()).device
-    if len(encoded_text) > 256:
-        p = round((len(encoded_text) - 256) / len(encoded_text) * 100, 1)
-        logger.warning(f"warning, text too long, lopping of last {p}%")
-        encoded_text = encoded_text[:256]
-    encoded_text = np.pad(
-        encoded_text,
-        (0, 256 - len(encoded_text)),
-        constant_values=TEXT_PAD_TOKEN,
-        mode="constant",
-    )
-    if semantic_history is not None:
-        semantic_history = semantic_history.astype(np.int64)
-        # lop off if history is too long, pad if needed
-        semantic_history = semantic_history[-256:]
-        semantic_history = np.pad(
-            semantic_history,
-            (0, 256 - len(semantic_history)),
-            constant_values=SEMANTIC_PAD_TOKEN,
-            mode="constant",
-        )
-    else:
-        semantic_history = np.array([SEMANTIC_PAD_TOKEN] * 256)
+    encoded_text = _encode_text_for_semantic(tokenizer, text)
+    if _is_offloaded("text"):
+        model_residency.acquire("text", model, models_devices["text"])
+    try:
+        device = next(model.parameters()).device
+        x = torch.from_numpy(
+            np.hstack([
+                encoded_text, semantic_history, np.array([SEMANTIC_INFER_TOKEN])
+            ]).astype(np.int64)
+        )[None]
+        assert x.shape[1] == 256 + 256 + 1
+        with _inference_mode():
+            x = x.to(device)
+            n_tot_steps = 768
+            # custom tqdm updates since we don't know when eos will occur
+            pbar = tqdm.tqdm(disable=silent, total=n_tot_steps)
+            pbar_state = 0
+            tot_generated_duration_s = 0
+            kv_cache = KVCache(model.config) if use_kv_caching else None
+            prefix_key = None
+            if use_kv_caching and SEMANTIC_PREFIX_CACHE_SIZE > 0:
+                prefix_key = _semantic_prefix_key(model, x)
+            # preallocate room for every generated token, `x_len` is the write cursor
+            x_len = x.shape[1]
+            x = F.pad(x, (0, n_tot_steps))
+            generators = make_generators(None if seed is None else [seed], device)
+            sampler = Sampler(temp, top_k=top_k, top_p=top_p, generators=generators)
+            for n in range(n_tot_steps):
+                if use_kv_caching and kv_cache.length > 0:
+                    x_input = x[:, x_len - 1 : x_len]
+                else:
+                    x_input = x[:, :x_len]
+                prefix = _get_semantic_prefix(prefix_key) if n == 0 and prefix_key else None
+                if prefix is not None:
+                    logits, prefix_kv = prefix
+                    kv_cache.load(prefix_kv)
+                elif use_kv_caching and kv_cache.length > 0:
+                    logits, kv_cache = _decode_step(model, x_input, kv_cache)
+                else:
+                    logits, kv_cache = model(
+                        x_input, merge_context=True, use_cache=use_kv_caching, past_kv=kv_cache
+                    )
+                    if n == 0 and prefix_key is not None:
+                        _put_semantic_prefix(prefix_key, logits, kv_cache.snapshot())
+                relevant_logits = logits[0, 0, :SEMANTIC_VOCAB_SIZE]
+                if allow_early_stop:
+                    relevant_logits = torch.hstack(
+                        (relevant_logits, logits[0, 0, [SEMANTIC_PAD_TOKEN]])  # eos
+                    )
+                item_next, probs = sampler(relevant_logits[None])
+                if allow_early_stop and _eos_rows(item_next, probs, min_eos_p).item():
+                    # eos found, so break
+                    pbar.update(n - pbar_state)
+                    break
+                x[:, x_len] = item_next[:, 0]
+                x_len += 1
+                tot_generated_duration_s += 1 / SEMANTIC_RATE_HZ
+                if max_gen_duration_s is not None and tot_generated_duration_s > max_gen_duration_s:
+                    pbar.update(n - pbar_state)
+                    break
+                if n == n_tot_steps - 1:
+                    pbar.update(n - pbar_state)
+                    break
+                del logits, relevant_logits, probs, item_next
+
+                if n > pbar_state:
+                    if n > pbar.total:
+                        pbar.total = n
+                    pbar.update(n - pbar_state)
+                pbar_state = n
+            pbar.total = n
+            pbar.refresh()
+            pbar.close()
+            out = x[0, 256 + 256 + 1 : x_len].detach().cpu().numpy()
+    finally:
+        if _is_offloaded("text"):
+            model_residency.release("text")
+    assert all(0 <= out) and all(out < SEMANTIC_VOCAB_SIZE)
+    _clear_cuda_cache()
+    return out
+
+
+def generate_text_semantic_batch(
+    texts,
+    history_prompts=None,
+    temp=0.7,
+    top_k=None,
+    top_p=None,
+    silent=False,
+    min_eos_p=0.2,
+    max_gen_duration_s=None,
+    allow_early_stop=True,
+    use_kv_caching=False,
+    seeds=None,
+    encoded_texts=None,
+):
+    """Generate semantic tokens for several texts at once.
+
+    All rows share the fixed 256 + 256 + 1 prefix layout, so they are stacked into a single
+    `[B, T]` tensor and decoded together. Rows that hit eos are dropped from the batch (and
+    from the kv cache) so they stop costing compute.
+
+    `history_prompts` is either a single history prompt used for every text or a list with
+    one entry per text, and `temp` is either one temperature or one per text. `seeds` gives each
+    text its own generator, so a row samples the same tokens whatever else is in the batch.
+    `encoded_texts` is the output of `encode_texts_for_semantic` for `texts`, when the texts
+    were already tokenized up front. Returns a list of semantic arrays in the order of `texts`.
+    """
+    assert isinstance(texts, (list, tuple)) and len(texts) > 0
+    if history_prompts is None or not isinstance(history_prompts, (list, tuple)):
+        history_prompts = [history_prompts] * len(texts)
+    assert len(history_prompts) == len(texts)
+    assert seeds is None or len(seeds) == len(texts)
+    texts = [_normalize_whitespace(text) for text in texts]
+    assert all(isinstance(text, str) and len(text) > 0 for text in texts)
+    # load models if not yet exist
+    global models
+    global models_devices
+    if "text" not in models:
+        preload_models()
+    model_container = models["text"]
+    model = model_container["model"]
+    tokenizer = model_container["tokenizer"]
+    if encoded_texts is None:
+        encoded_texts = encode_texts_for_semantic(texts, tokenizer=tokenizer)
+    assert encoded_texts.shape == (len(texts), 256)
     x = torch.from_numpy(
         np.hstack([
-            encoded_text, semantic_history, np.array([SEMANTIC_INFER_TOKEN])
+            encoded_texts,
+            np.stack([_load_semantic_history(prompt) for prompt in history_prompts]),
+            np.full((len(texts), 1), SEMANTIC_INFER_TOKEN),
         ]).astype(np.int64)
-    )[None]
+    )
     assert x.shape[1] == 256 + 256 + 1
-    with _inference_mode():
-        x = x.to(device)
-        n_tot_steps = 768
-        # custom tqdm updates since we don't know when eos will occur
-        pbar = tqdm.tqdm(disable=silent, total=n_tot_steps)
-        pbar_state = 0
-        tot_generated_duration_s = 0
-        kv_cache = None
-        for n in range(n_tot_steps):
-            if use_kv_caching and kv_cache is not None:
-                x_input = x[:, [-1]]
-            else:
-                x_input = x
-            logits, kv_cache = model(
-                x_input, merge_context=True, use_cache=use_kv_caching, past_kv=kv_cache
-            )
-            relevant_logits = logits[0, 0, :SEMANTIC_VOCAB_SIZE]
-            if allow_early_stop:
-                relevant_logits = torch.hstack(
-                    (relevant_logits, logits[0, 0, [SEMANTIC_PAD_TOKEN]])  # eos
+    if _is_offloaded("text"):
+        model_residency.acquire("text", model, models_devices["text"])
+    try:
+        device = next(model.parameters()).device
+        outs = [None] * len(texts)
+        with _inference_mode():
+            x = x.to(device)
+            # original batch position of each row still being generated
+            active = torch.arange(len(texts), device=device)
+            n_tot_steps = 768
+            pbar = tqdm.tqdm(disable=silent, total=n_tot_steps)
+            tot_generated_duration_s = 0
+            kv_cache = KVCache(model.config, batch_size=len(texts)) if use_kv_caching else None
+            # preallocate room for every generated token, `x_len` is the write cursor
+            x_len = x.shape[1]
+            x = F.pad(x, (0, n_tot_steps))
+            generators = make_generators(seeds, device)
+            sampler = Sampler(temp, top_k=top_k, top_p=top_p, generators=generators)
+            for n in range(n_tot_steps):
+                if use_kv_caching and kv_cache.length > 0:
+                    x_input = x[:, x_len - 1 : x_len]
+                else:
+                    x_input = x[:, :x_len]
+                logits, kv_cache = model(
+                    x_input, merge_context=True, use_cache=use_kv_caching, past_kv=kv_cache
                 )
-            if top_p is not None:
-                # faster to convert to numpy
-                original_device = relevant_logits.device
-                relevant_logits = relevant_logits.detach().cpu().type(torch.float32).numpy()
-                sorted_indices = np.argsort(relevant_logits)[::-1]
-                sorted_logits = relevant_logits[sorted_indices]
-                cumulative_probs = np.cumsum(softmax(sorted_logits))
-                sorted_indices_to_remove = cumulative_probs > top_p
-                sorted_indices_to_remove[1:] = sorted_indices_to_remove[:-1].copy()
-                sorted_indices_to_remove[0] = False
-                relevant_logits[sorted_indices[sorted_indices_to_remove]] = -np.inf
-                relevant_logits = torch.from_numpy(relevant_logits)
-                relevant_logits = relevant_logits.to(original_device)
-            if top_k is not None:
-                v, _ = torch.topk(relevant_logits, min(top_k, relevant_logits.size(-1)))
-                relevant_logits[relevant_logits < v[-1]] = -float("Inf")
-            probs = F.softmax(relevant_logits / temp, dim=-1)
-            item_next = torch.multinomial(probs, num_samples=1).to(torch.int32)
-            if allow_early_stop and (
-                item_next == SEMANTIC_VOCAB_SIZE
-                or (min_eos_p is not None and probs[-1] >= min_eos_p)
-            ):
-                # eos found, so break
-                pbar.update(n - pbar_state)
-                break
-            x = torch.cat((x, item_next[None]), dim=1)
-            tot_generated_duration_s += 1 / SEMANTIC_RATE_HZ
-            if max_gen_duration_s is not None and tot_generated_duration_s > max_gen_duration_s:
-                pbar.update(n - pbar_state)
-                break
-            if n == n_tot_steps - 1:
-                pbar.update(n - pbar_state)
-                break
-            del logits, relevant_logits, probs, item_next
-
-            if n > pbar_state:
-                if n > pbar.total:
-                    pbar.total = n
-                pbar.update(n - pbar_state)
-            pbar_state = n
-        pbar.total = n
-        pbar.refresh()
-        pbar.close()
-        out = x.detach().cpu().numpy().squeeze()[256 + 256 + 1 :]
-    if OFFLOAD_CPU:
-        model.to("cpu")
-    assert all(0 <= out) and all(out < SEMANTIC_VOCAB_SIZE)
+                relevant_logits = logits[:, 0, :SEMANTIC_VOCAB_SIZE]
+                if allow_early_stop:
+                    relevant_logits = torch.hstack(
+                        (relevant_logits, logits[:, 0, [SEMANTIC_PAD_TOKEN]])  # eos
+                    )
+                item_next, probs = sampler(relevant_logits)
+                if allow_early_stop:
+                    is_eos = _eos_rows(item_next, probs, min_eos_p)
+                    if is_eos.any():
+                        for row, out in zip(active[is_eos].tolist(), x[is_eos]):
+                            outs[row] = out[256 + 256 + 1 : x_len].cpu().numpy()
+                        keep = ~is_eos
+                        if not keep.any():
+                            pbar.update(1)
+                            break
+                        active, x, item_next = active[keep], x[keep], item_next[keep]
+                        kv_cache = _select_kv_rows(kv_cache, keep)
+                        sampler.select_rows(keep)
+                x[:, x_len] = item_next[:, 0]
+                x_len += 1
+                pbar.update(1)
+                tot_generated_duration_s += 1 / SEMANTIC_RATE_HZ
+                if max_gen_duration_s is not None and tot_generated_duration_s > max_gen_duration_s:
+                    break
+                del logits, relevant_logits, probs, item_next
+            for row, out in zip(active.tolist(), x):
+                if outs[row] is None:
+                    outs[row] = out[256 + 256 + 1 : x_len].cpu().numpy()
+            pbar.total = n + 1
+            pbar.refresh()
+            pbar.close()
+    finally:
+        if _is_offloaded("text"):
+            model_residency.release("text")
+    for out in outs:
+        assert all(0 <= out) and all(out < SEMANTIC_VOCAB_SIZE)
     _clear_cuda_cache()
-    return out
+    return outs
 
 
 def _flatten_codebooks(arr, offset_size=CODEBOOK_SIZE):
@@ -528,29 +1158,7 @@ COARSE_SEMANTIC_PAD_TOKEN = 12_048
 COARSE_INFER_TOKEN = 12_050
 
 
-def generate_coarse(
-    x_semantic,
-    history_prompt=None,
-    temp=0.7,
-    top_k=None,
-    top_p=None,
-    silent=False,
-    max_coarse_history=630,  # min 60 (faster), max 630 (more context)
-    sliding_window_len=60,
-    use_kv_caching=False,
-):
-    """Generate coarse audio codes from semantic tokens."""
-    assert (
-        isinstance(x_semantic, np.ndarray)
-        and len(x_semantic.shape) == 1
-        and len(x_semantic) > 0
-        and x_semantic.min() >= 0
-        and x_semantic.max() <= SEMANTIC_VOCAB_SIZE - 1
-    )
-    assert 60 <= max_coarse_history <= 630
-    assert max_coarse_history + sliding_window_len <= 1024 - 256
-    semantic_to_coarse_ratio = COARSE_RATE_HZ / SEMANTIC_RATE_HZ * N_COARSE_CODEBOOKS
-    max_semantic_history = int(np.floor(max_coarse_history / semantic_to_coarse_ratio))
+def _load_coarse_history(history_prompt, max_semantic_history, semantic_to_coarse_ratio):
     if history_prompt is not None:
         history_prompt = _load_history_prompt(history_prompt)
         x_semantic_history = history_prompt["semantic_prompt"]
@@ -589,15 +1197,86 @@ def generate_coarse(
     else:
         x_semantic_history = np.array([], dtype=np.int32)
         x_coarse_history = np.array([], dtype=np.int32)
+    return x_semantic_history, x_coarse_history
+
+
+def _unflatten_coarse(gen_coarse_arr):
+    gen_coarse_audio_arr = gen_coarse_arr.reshape(-1, N_COARSE_CODEBOOKS).T - SEMANTIC_VOCAB_SIZE
+    for n in range(1, N_COARSE_CODEBOOKS):
+        gen_coarse_audio_arr[n, :] -= n * CODEBOOK_SIZE
+    return gen_coarse_audio_arr
+
+
+def generate_coarse(
+    x_semantic,
+    history_prompt=None,
+    temp=0.7,
+    top_k=None,
+    top_p=None,
+    silent=False,
+    max_coarse_history=630,  # min 60 (faster), max 630 (more context)
+    sliding_window_len=60,
+    use_kv_caching=False,
+    seed=None,
+):
+    """Generate coarse audio codes from semantic tokens."""
+    gen_coarse_audio_arr = np.hstack(
+        list(
+            generate_coarse_stream(
+                x_semantic,
+                history_prompt=history_prompt,
+                temp=temp,
+                top_k=top_k,
+                top_p=top_p,
+                silent=silent,
+                max_coarse_history=max_coarse_history,
+                sliding_window_len=sliding_window_len,
+                use_kv_caching=use_kv_caching,
+                seed=seed,
+            )
+        )
+    )
+    return gen_coarse_audio_arr
+
+
+def generate_coarse_stream(
+    x_semantic,
+    history_prompt=None,
+    temp=0.7,
+    top_k=None,
+    top_p=None,
+    silent=False,
+    max_coarse_history=630,  # min 60 (faster), max 630 (more context)
+    sliding_window_len=60,
+    use_kv_caching=False,
+    seed=None,
+):
+    """Generate coarse audio codes from semantic tokens, yielding the codes of each sliding window.
+
+    Concatenating the yielded arrays along the last axis gives the output of `generate_coarse`.
+    Only whole frames are yielded, with an odd `sliding_window_len` a half frame left at the end
+    of a window is yielded with the next one.
+    """
+    assert (
+        isinstance(x_semantic, np.ndarray)
+        and len(x_semantic.shape) == 1
+        and len(x_semantic) > 0
+        and x_semantic.min() >= 0
+        and x_semantic.max() <= SEMANTIC_VOCAB_SIZE - 1
+    )
+    assert 60 <= max_coarse_history <= 630
+    assert max_coarse_history + sliding_window_len <= 1024 - 256
+    semantic_to_coarse_ratio = COARSE_RATE_HZ / SEMANTIC_RATE_HZ * N_COARSE_CODEBOOKS
+    max_semantic_history = int(np.floor(max_coarse_history / semantic_to_coarse_ratio))
+    x_semantic_history, x_coarse_history = _load_coarse_history(
+        history_prompt, max_semantic_history, semantic_to_coarse_ratio
+    )
     # load models if not yet exist
     global models
     global models_devices
     if "coarse" not in models:
         preload_models()
     model = models["coarse"]
-    if OFFLOAD_CPU:
-        model.to(models_devices["coarse"])
-    device = next(model.parameters()).device
     # start loop
     n_steps = int(
         round(
@@ -609,92 +1288,272 @@ def generate_coarse(
     x_semantic = np.hstack([x_semantic_history, x_semantic]).astype(np.int32)
     x_coarse = x_coarse_history.astype(np.int32)
     base_semantic_idx = len(x_semantic_history)
-    with _inference_mode():
-        x_semantic_in = torch.from_numpy(x_semantic)[None].to(device)
-        x_coarse_in = torch.from_numpy(x_coarse)[None].to(device)
+    if _is_offloaded("coarse"):
+        model_residency.acquire("coarse", model, models_devices["coarse"])
+    try:
+        device = next(model.parameters()).device
+        max_window_len = 256 + 1 + max_coarse_history + sliding_window_len
+        with _inference_mode():
+            x_semantic_in = torch.from_numpy(x_semantic)[None].to(device)
+            # preallocated token buffers, `x_coarse_len` and `x_in_len` are the write cursors
+            x_coarse_in = F.pad(torch.from_numpy(x_coarse)[None].to(device), (0, n_steps))
+            x_coarse_len = len(x_coarse)
+            x_in = torch.empty((1, max_window_len), dtype=torch.int32, device=device)
         n_window_steps = int(np.ceil(n_steps / sliding_window_len))
         n_step = 0
+        # end of the coarse tokens yielded so far, always a whole number of frames
+        n_yielded = x_coarse_len
+        kv_cache = None
+        if use_kv_caching:
+            kv_cache = KVCache(model.config, max_len=max_window_len)
+        generators = make_generators(None if seed is None else [seed], device)
+        sampler = Sampler(temp, top_k=top_k, top_p=top_p, generators=generators)
         for _ in tqdm.tqdm(range(n_window_steps), total=n_window_steps, disable=silent):
-            semantic_idx = base_semantic_idx + int(round(n_step / semantic_to_coarse_ratio))
-            # pad from right side
-            x_in = x_semantic_in[:, np.max([0, semantic_idx - max_semantic_history]) :]
-            x_in = x_in[:, :256]
-            x_in = F.pad(
-                x_in,
-                (0, 256 - x_in.shape[-1]),
-                "constant",
-                COARSE_SEMANTIC_PAD_TOKEN,
-            )
-            x_in = torch.hstack(
-                [
-                    x_in,
-                    torch.tensor([COARSE_INFER_TOKEN])[None].to(device),
-                    x_coarse_in[:, -max_coarse_history:],
+            # the inference context is re-entered per window so it does not leak to the caller
+            with _inference_mode():
+                semantic_idx = base_semantic_idx + int(round(n_step / semantic_to_coarse_ratio))
+                # pad from right side
+                x_semantic_window = x_semantic_in[
+                    :, np.max([0, semantic_idx - max_semantic_history]) :
                 ]
+                x_semantic_window = x_semantic_window[:, :256]
+                x_in[:, : x_semantic_window.shape[-1]] = x_semantic_window
+                x_in[:, x_semantic_window.shape[-1] : 256] = COARSE_SEMANTIC_PAD_TOKEN
+                x_in[:, 256] = COARSE_INFER_TOKEN
+                n_coarse_window = min(x_coarse_len, max_coarse_history)
+                x_in[:, 257 : 257 + n_coarse_window] = x_coarse_in[
+                    :, x_coarse_len - n_coarse_window : x_coarse_len
+                ]
+                x_in_len = 257 + n_coarse_window
+                if use_kv_caching:
+                    kv_cache.reset()
+                for _ in range(sliding_window_len):
+                    if n_step >= n_steps:
+                        continue
+                    is_major_step = n_step % N_COARSE_CODEBOOKS == 0
+
+                    if use_kv_caching and kv_cache.length > 0:
+                        x_input = x_in[:, x_in_len - 1 : x_in_len]
+                    else:
+                        x_input = x_in[:, :x_in_len]
+
+                    if use_kv_caching and kv_cache.length > 0:
+                        logits, kv_cache = _decode_step(model, x_input, kv_cache)
+                    else:
+                        logits, kv_cache = model(
+                            x_input, use_cache=use_kv_caching, past_kv=kv_cache
+                        )
+                    logit_start_idx = (
+                        SEMANTIC_VOCAB_SIZE + (1 - int(is_major_step)) * CODEBOOK_SIZE
+                    )
+                    logit_end_idx = (
+                        SEMANTIC_VOCAB_SIZE + (2 - int(is_major_step)) * CODEBOOK_SIZE
+                    )
+                    relevant_logits = logits[:, 0, logit_start_idx:logit_end_idx]
+                    item_next, probs = sampler(relevant_logits)
+                    item_next += logit_start_idx
+                    x_coarse_in[:, x_coarse_len] = item_next[:, 0]
+                    x_in[:, x_in_len] = item_next[:, 0]
+                    x_coarse_len += 1
+                    x_in_len += 1
+                    del logits, relevant_logits, probs, item_next
+                    n_step += 1
+                # with an odd `sliding_window_len` a window can end mid frame, the half frame
+                # is yielded with the next window
+                n_yield_end = x_coarse_len - (x_coarse_len - n_yielded) % N_COARSE_CODEBOOKS
+                gen_window_arr = x_coarse_in[0, n_yielded:n_yield_end].detach().cpu().numpy()
+                n_yielded = n_yield_end
+            if len(gen_window_arr) > 0:
+                yield _unflatten_coarse(gen_window_arr)
+        assert x_coarse_len - len(x_coarse_history) == n_steps
+        del x_semantic_in, x_coarse_in, x_in
+    finally:
+        if _is_offloaded("coarse"):
+            model_residency.release("coarse")
+        _clear_cuda_cache()
+
+
+def generate_coarse_batch(
+    x_semantics,
+    history_prompts=None,
+    temp=0.7,
+    top_k=None,
+    top_p=None,
+    silent=False,
+    max_coarse_history=630,  # min 60 (faster), max 630 (more context)
+    sliding_window_len=60,
+    use_kv_caching=False,
+    seeds=None,
+):
+    """Generate coarse audio codes for several semantic arrays at once.
+
+    Every row starts at the same step, so all rows share one sliding window schedule and one
+    `model(...)` call per step. Rows whose coarse history has a different length are left padded
+    and masked out. Rows that have produced all their steps are dropped from the batch.
+
+    `history_prompts` is either a single history prompt used for every row or a list with one
+    entry per semantic array, and `temp` is either one temperature or one per row. `seeds` gives
+    each row its own generator. Returns a list of coarse arrays in the order of `x_semantics`.
+    """
+    assert isinstance(x_semantics, (list, tuple)) and len(x_semantics) > 0
+    for x_semantic in x_semantics:
+        assert (
+            isinstance(x_semantic, np.ndarray)
+            and len(x_semantic.shape) == 1
+            and len(x_semantic) > 0
+            and x_semantic.min() >= 0
+            and x_semantic.max() <= SEMANTIC_VOCAB_SIZE - 1
+        )
+    if history_prompts is None or not isinstance(history_prompts, (list, tuple)):
+        history_prompts = [history_prompts] * len(x_semantics)
+    assert len(history_prompts) == len(x_semantics)
+    assert seeds is None or len(seeds) == len(x_semantics)
+    assert 60 <= max_coarse_history <= 630
+    assert max_coarse_history + sliding_window_len <= 1024 - 256
+    semantic_to_coarse_ratio = COARSE_RATE_HZ / SEMANTIC_RATE_HZ * N_COARSE_CODEBOOKS
+    max_semantic_history = int(np.floor(max_coarse_history / semantic_to_coarse_ratio))
+    histories = [
+        _load_coarse_history(history_prompt, max_semantic_history, semantic_to_coarse_ratio)
+        for history_prompt in history_prompts
+    ]
+    # load models if not yet exist
+    global models
+    global models_devices
+    if "coarse" not in models:
+        preload_models()
+    model = models["coarse"]
+    if _is_offloaded("coarse"):
+        model_residency.acquire("coarse", model, models_devices["coarse"])
+    try:
+        device = next(model.parameters()).device
+        n_steps = [
+            int(
+                round(
+                    np.floor(len(x_semantic) * semantic_to_coarse_ratio / N_COARSE_CODEBOOKS)
+                    * N_COARSE_CODEBOOKS
+                )
+            )
+            for x_semantic in x_semantics
+        ]
+        assert all(n > 0 and n % N_COARSE_CODEBOOKS == 0 for n in n_steps)
+        with _inference_mode():
+            x_semantic_ins = [
+                torch.from_numpy(np.hstack([x_semantic_history, x_semantic]).astype(np.int32))
+                .to(device)
+                for x_semantic, (x_semantic_history, _) in zip(x_semantics, histories)
+            ]
+            x_coarse_histories = [
+                torch.from_numpy(x_coarse_history.astype(np.int32)).to(device)
+                for _, x_coarse_history in histories
+            ]
+            # generated coarse tokens, all rows advance in lockstep so they share the write index
+            gen_coarse = torch.zeros(
+                (len(x_semantics), max(n_steps)), dtype=torch.int32, device=device
             )
+            infer_token = torch.tensor([COARSE_INFER_TOKEN], dtype=torch.int32, device=device)
+            n_window_steps = int(np.ceil(max(n_steps) / sliding_window_len))
+            n_step = 0
             kv_cache = None
-            for _ in range(sliding_window_len):
-                if n_step >= n_steps:
-                    continue
-                is_major_step = n_step % N_COARSE_CODEBOOKS == 0
-
-                if use_kv_caching and kv_cache is not None:
-                    x_input = x_in[:, [-1]]
-                else:
-                    x_input = x_in
-
-                logits, kv_cache = model(x_input, use_cache=use_kv_caching, past_kv=kv_cache)
-                logit_start_idx = (
-                    SEMANTIC_VOCAB_SIZE + (1 - int(is_major_step)) * CODEBOOK_SIZE
-                )
-                logit_end_idx = (
-                    SEMANTIC_VOCAB_SIZE + (2 - int(is_major_step)) * CODEBOOK_SIZE
-                )
-                relevant_logits = logits[0, 0, logit_start_idx:logit_end_idx]
-                if top_p is not None:
-                    # faster to convert to numpy
-                    original_device = relevant_logits.device
-                    relevant_logits = relevant_logits.detach().cpu().type(torch.float32).numpy()
-                    sorted_indices = np.argsort(relevant_logits)[::-1]
-                    sorted_logits = relevant_logits[sorted_indices]
-                    cumulative_probs = np.cumsum(softmax(sorted_logits))
-                    sorted_indices_to_remove = cumulative_probs > top_p
-                    sorted_indices_to_remove[1:] = sorted_indices_to_remove[:-1].copy()
-                    sorted_indices_to_remove[0] = False
-                    relevant_logits[sorted_indices[sorted_indices_to_remove]] = -np.inf
-                    relevant_logits = torch.from_numpy(relevant_logits)
-                    relevant_logits = relevant_logits.to(original_device)
-                if top_k is not None:
-                    v, _ = torch.topk(relevant_logits, min(top_k, relevant_logits.size(-1)))
-                    relevant_logits[relevant_logits < v[-1]] = -float("Inf")
-                probs = F.softmax(relevant_logits / temp, dim=-1)
-                item_next = torch.multinomial(probs, num_samples=1).to(torch.int32)
-                item_next += logit_start_idx
-                x_coarse_in = torch.cat((x_coarse_in, item_next[None]), dim=1)
-                x_in = torch.cat((x_in, item_next[None]), dim=1)
-                del logits, relevant_logits, probs, item_next
-                n_step += 1
-            del x_in
-        del x_semantic_in
-    if OFFLOAD_CPU:
-        model.to("cpu")
-    gen_coarse_arr = x_coarse_in.detach().cpu().numpy().squeeze()[len(x_coarse_history) :]
-    del x_coarse_in
-    assert len(gen_coarse_arr) == n_steps
-    gen_coarse_audio_arr = gen_coarse_arr.reshape(-1, N_COARSE_CODEBOOKS).T - SEMANTIC_VOCAB_SIZE
-    for n in range(1, N_COARSE_CODEBOOKS):
-        gen_coarse_audio_arr[n, :] -= n * CODEBOOK_SIZE
+            # finished rows never come back, so the sampler rows follow `active` across windows
+            generators = make_generators(seeds, device)
+            sampler = Sampler(temp, top_k=top_k, top_p=top_p, generators=generators)
+            for _ in tqdm.tqdm(range(n_window_steps), total=n_window_steps, disable=silent):
+                active = [row for row in range(len(x_semantics)) if n_step < n_steps[row]]
+                rows = []
+                for row in active:
+                    base_semantic_idx = len(histories[row][0])
+                    semantic_idx = base_semantic_idx + int(round(n_step / semantic_to_coarse_ratio))
+                    x_in = x_semantic_ins[row][np.max([0, semantic_idx - max_semantic_history]) :]
+                    x_in = x_in[:256]
+                    x_in = F.pad(x_in, (0, 256 - len(x_in)), "constant", COARSE_SEMANTIC_PAD_TOKEN)
+                    x_coarse = torch.hstack([x_coarse_histories[row], gen_coarse[row, :n_step]])
+                    rows.append(torch.hstack([x_in, infer_token, x_coarse[-max_coarse_history:]]))
+                max_len = max(len(x_row) for x_row in rows)
+                # pad from left side so the last position of every row is the next token to predict,
+                # and leave room on the right for the window, `x_in_len` is the write cursor
+                x_in = torch.stack([
+                    F.pad(
+                        x_row,
+                        (max_len - len(x_row), sliding_window_len),
+                        "constant",
+                        COARSE_SEMANTIC_PAD_TOKEN,
+                    )
+                    for x_row in rows
+                ])
+                attention_mask = torch.stack([
+                    F.pad(
+                        torch.ones(
+                            len(x_row) + sliding_window_len, dtype=torch.bool, device=device
+                        ),
+                        (max_len - len(x_row), 0),
+                    )
+                    for x_row in rows
+                ])
+                if all(len(x_row) == max_len for x_row in rows):
+                    attention_mask = None
+                x_in_len = max_len
+                active_idx = torch.tensor(active, device=device)
+                if use_kv_caching:
+                    if kv_cache is None or kv_cache.batch_size != len(active):
+                        kv_cache = KVCache(
+                            model.config,
+                            batch_size=len(active),
+                            max_len=256 + 1 + max_coarse_history + sliding_window_len,
+                        )
+                    kv_cache.reset()
+                for _ in range(sliding_window_len):
+                    if len(active) == 0:
+                        break
+                    is_major_step = n_step % N_COARSE_CODEBOOKS == 0
+
+                    if use_kv_caching and kv_cache.length > 0:
+                        x_input = x_in[:, x_in_len - 1 : x_in_len]
+                    else:
+                        x_input = x_in[:, :x_in_len]
+
+                    logits, kv_cache = model(
+                        x_input,
+                        use_cache=use_kv_caching,
+                        past_kv=kv_cache,
+                        attention_mask=(
+                            None if attention_mask is None else attention_mask[:, :x_in_len]
+                        ),
+                    )
+                    logit_start_idx = (
+                        SEMANTIC_VOCAB_SIZE + (1 - int(is_major_step)) * CODEBOOK_SIZE
+                    )
+                    logit_end_idx = (
+                        SEMANTIC_VOCAB_SIZE + (2 - int(is_major_step)) * CODEBOOK_SIZE
+                    )
+                    relevant_logits = logits[:, 0, logit_start_idx:logit_end_idx]
+                    item_next, _ = sampler(relevant_logits)
+                    item_next += logit_start_idx
+                    gen_coarse[active_idx, n_step] = item_next[:, 0]
+                    x_in[:, x_in_len] = item_next[:, 0]
+                    x_in_len += 1
+                    del logits, relevant_logits, item_next
+                    n_step += 1
+                    keep = [n_step < n_steps[row] for row in active]
+                    if not all(keep):
+                        active = [row for row, row_keep in zip(active, keep) if row_keep]
+                        keep = torch.tensor(keep, device=device)
+                        active_idx, x_in = active_idx[keep], x_in[keep]
+                        if attention_mask is not None:
+                            attention_mask = attention_mask[keep]
+                        kv_cache = _select_kv_rows(kv_cache, keep)
+                        sampler.select_rows(keep)
+                del x_in
+            del x_semantic_ins
+    finally:
+        if _is_offloaded("coarse"):
+            model_residency.release("coarse")
+    gen_coarse = gen_coarse.detach().cpu().numpy()
+    outs = [_unflatten_coarse(gen_coarse[row, : n_steps[row]]) for row in range(len(x_semantics))]
     _clear_cuda_cache()
-    return gen_coarse_audio_arr
+    return outs
 
 
-def generate_fine(
-    x_coarse_gen,
-    history_prompt=None,
-    temp=0.5,
-    silent=True,
-):
-    """Generate full audio codes from coarse audio codes."""
+def _prepare_fine_input(x_coarse_gen, history_prompt):
     assert (
         isinstance(x_coarse_gen, np.ndarray)
         and len(x_coarse_gen.shape) == 2
@@ -717,15 +1576,6 @@ def generate_fine(
     else:
         x_fine_history = None
     n_coarse = x_coarse_gen.shape[0]
-    # load models if not yet exist
-    global models
-    global models_devices
-    if "fine" not in models:
-        preload_models()
-    model = models["fine"]
-    if OFFLOAD_CPU:
-        model.to(models_devices["fine"])
-    device = next(model.parameters()).device
     # make input arr
     in_arr = np.vstack(
         [
@@ -758,37 +1608,66 @@ def generate_fine(
         )
     # we can be lazy about fractional loop and just keep overwriting codebooks
     n_loops = np.max([0, int(np.ceil((x_coarse_gen.shape[1] - (1024 - n_history)) / 512))]) + 1
-    with _inference_mode():
-        in_arr = torch.tensor(in_arr.T).to(device)
-        for n in tqdm.tqdm(range(n_loops), disable=silent):
-            start_idx = np.min([n * 512, in_arr.shape[0] - 1024])
-            start_fill_idx = np.min([n_history + n * 512, in_arr.shape[0] - 512])
-            rel_start_fill_idx = start_fill_idx - start_idx
-            in_buffer = in_arr[start_idx : start_idx + 1024, :][None]
-            for nn in range(n_coarse, N_FINE_CODEBOOKS):
-                logits = model(nn, in_buffer)
-                if temp is None:
-                    relevant_logits = logits[0, rel_start_fill_idx:, :CODEBOOK_SIZE]
-                    codebook_preds = torch.argmax(relevant_logits, -1)
-                else:
-                    relevant_logits = logits[0, :, :CODEBOOK_SIZE] / temp
-                    probs = F.softmax(relevant_logits, dim=-1)
-                    codebook_preds = torch.multinomial(
-                        probs[rel_start_fill_idx:1024], num_samples=1
-                    ).reshape(-1)
-                codebook_preds = codebook_preds.to(torch.int32)
-                in_buffer[0, rel_start_fill_idx:, nn] = codebook_preds
-                del logits, codebook_preds
-            # transfer over info into model_in and convert to numpy
-            for nn in range(n_coarse, N_FINE_CODEBOOKS):
-                in_arr[
-                    start_fill_idx : start_fill_idx + (1024 - rel_start_fill_idx), nn
-                ] = in_buffer[0, rel_start_fill_idx:, nn]
-            del in_buffer
-        gen_fine_arr = in_arr.detach().cpu().numpy().squeeze().T
-        del in_arr
-    if OFFLOAD_CPU:
-        model.to("cpu")
+    return in_arr, n_history, n_remove_from_end, n_loops
+
+
+def generate_fine(
+    x_coarse_gen,
+    history_prompt=None,
+    temp=0.5,
+    silent=True,
+    seed=None,
+):
+    """Generate full audio codes from coarse audio codes."""
+    in_arr, n_history, n_remove_from_end, n_loops = _prepare_fine_input(
+        x_coarse_gen, history_prompt
+    )
+    n_coarse = x_coarse_gen.shape[0]
+    # load models if not yet exist
+    global models
+    global models_devices
+    if "fine" not in models:
+        preload_models()
+    model = models["fine"]
+    if _is_offloaded("fine"):
+        model_residency.acquire("fine", model, models_devices["fine"])
+    try:
+        device = next(model.parameters()).device
+        with _inference_mode():
+            in_arr = torch.tensor(in_arr.T).to(device)
+            generator = None
+            if seed is not None:
+                (generator,) = make_generators([seed], device)
+            for n in tqdm.tqdm(range(n_loops), disable=silent):
+                start_idx = np.min([n * 512, in_arr.shape[0] - 1024])
+                start_fill_idx = np.min([n_history + n * 512, in_arr.shape[0] - 512])
+                rel_start_fill_idx = start_fill_idx - start_idx
+                in_buffer = in_arr[start_idx : start_idx + 1024, :][None]
+                for nn in range(n_coarse, N_FINE_CODEBOOKS):
+                    logits = model(nn, in_buffer)
+                    if temp is None:
+                        relevant_logits = logits[0, rel_start_fill_idx:, :CODEBOOK_SIZE]
+                        codebook_preds = torch.argmax(relevant_logits, -1)
+                    else:
+                        relevant_logits = logits[0, :, :CODEBOOK_SIZE] / temp
+                        probs = F.softmax(relevant_logits, dim=-1)
+                        codebook_preds = torch.multinomial(
+                            probs[rel_start_fill_idx:1024], num_samples=1, generator=generator
+                        ).reshape(-1)
+                    codebook_preds = codebook_preds.to(torch.int32)
+                    in_buffer[0, rel_start_fill_idx:, nn] = codebook_preds
+                    del logits, codebook_preds
+                # transfer over info into model_in and convert to numpy
+                for nn in range(n_coarse, N_FINE_CODEBOOKS):
+                    in_arr[
+                        start_fill_idx : start_fill_idx + (1024 - rel_start_fill_idx), nn
+                    ] = in_buffer[0, rel_start_fill_idx:, nn]
+                del in_buffer
+            gen_fine_arr = in_arr.detach().cpu().numpy().squeeze().T
+            del in_arr
+    finally:
+        if _is_offloaded("fine"):
+            model_residency.release("fine")
     gen_fine_arr = gen_fine_arr[:, n_history:]
     if n_remove_from_end > 0:
         gen_fine_arr = gen_fine_arr[:, :-n_remove_from_end]
@@ -797,6 +1676,119 @@ def generate_fine(
     return gen_fine_arr
 
 
+def generate_fine_batch(
+    x_coarse_gens,
+    history_prompts=None,
+    temp=0.5,
+    silent=True,
+    seeds=None,
+):
+    """Generate full audio codes for several coarse arrays at once.
+
+    FineGPT is non-causal over a fixed 1024 frame window, so the n-th window of every coarse
+    array is packed into one `[B, 1024, 8]` buffer and each codebook is predicted for all of
+    them in a single forward pass.
+
+    `history_prompts` is either a single history prompt used for every row or a list with one
+    entry per coarse array. `seeds` gives each row its own generator. Returns a list of fine
+    arrays in the order of `x_coarse_gens`.
+    """
+    assert isinstance(x_coarse_gens, (list, tuple)) and len(x_coarse_gens) > 0
+    if history_prompts is None or not isinstance(history_prompts, (list, tuple)):
+        history_prompts = [history_prompts] * len(x_coarse_gens)
+    assert len(history_prompts) == len(x_coarse_gens)
+    assert seeds is None or len(seeds) == len(x_coarse_gens)
+    preps = [
+        _prepare_fine_input(x_coarse_gen, history_prompt)
+        for x_coarse_gen, history_prompt in zip(x_coarse_gens, history_prompts)
+    ]
+    n_coarses = [x_coarse_gen.shape[0] for x_coarse_gen in x_coarse_gens]
+    # load models if not yet exist
+    global models
+    global models_devices
+    if "fine" not in models:
+        preload_models()
+    model = models["fine"]
+    if _is_offloaded("fine"):
+        model_residency.acquire("fine", model, models_devices["fine"])
+    try:
+        device = next(model.parameters()).device
+        gen_fine_arrs = []
+        with _inference_mode():
+            in_arrs = [torch.tensor(in_arr.T).to(device) for in_arr, _, _, _ in preps]
+            n_coarse_in = torch.tensor(n_coarses, device=device)
+            fill_positions = torch.arange(1024, device=device)
+            generators = make_generators(seeds, device)
+            for n in tqdm.tqdm(range(max(prep[3] for prep in preps)), disable=silent):
+                rows = [row for row, prep in enumerate(preps) if n < prep[3]]
+                start_idxs, start_fill_idxs, rel_start_fill_idxs = [], [], []
+                for row in rows:
+                    n_history = preps[row][1]
+                    start_idx = np.min([n * 512, in_arrs[row].shape[0] - 1024])
+                    start_fill_idx = np.min([n_history + n * 512, in_arrs[row].shape[0] - 512])
+                    start_idxs.append(start_idx)
+                    start_fill_idxs.append(start_fill_idx)
+                    rel_start_fill_idxs.append(start_fill_idx - start_idx)
+                in_buffer = torch.stack([
+                    in_arrs[row][start_idx : start_idx + 1024, :]
+                    for row, start_idx in zip(rows, start_idxs)
+                ])
+                rel_start_fill_in = torch.tensor(rel_start_fill_idxs, device=device)
+                fill_mask = fill_positions[None] >= rel_start_fill_in[:, None]
+                row_n_coarse = n_coarse_in[rows]
+                for nn in range(min(n_coarses[row] for row in rows), N_FINE_CODEBOOKS):
+                    logits = model(nn, in_buffer)
+                    if temp is None:
+                        relevant_logits = logits[:, :, :CODEBOOK_SIZE]
+                        codebook_preds = torch.argmax(relevant_logits, -1)
+                    else:
+                        relevant_logits = logits[:, :, :CODEBOOK_SIZE] / temp
+                        probs = F.softmax(relevant_logits, dim=-1)
+                        if generators is None:
+                            codebook_preds = torch.multinomial(
+                                probs.reshape(-1, CODEBOOK_SIZE), num_samples=1
+                            ).reshape(len(rows), 1024)
+                        else:
+                            # sample the same positions as `generate_fine` so seeded rows match it
+                            codebook_preds = in_buffer[:, :, nn].clone()
+                            for b, (row, rel_start_fill_idx) in enumerate(
+                                zip(rows, rel_start_fill_idxs)
+                            ):
+                                if n_coarses[row] > nn:
+                                    # given codebook, `generate_fine` draws nothing for it
+                                    continue
+                                codebook_preds[b, rel_start_fill_idx:] = torch.multinomial(
+                                    probs[b, rel_start_fill_idx:],
+                                    num_samples=1,
+                                    generator=generators[row],
+                                ).reshape(-1)
+                    codebook_preds = codebook_preds.to(torch.int32)
+                    update = fill_mask & (row_n_coarse <= nn)[:, None]
+                    in_buffer[:, :, nn] = torch.where(update, codebook_preds, in_buffer[:, :, nn])
+                    del logits, codebook_preds
+                # transfer over info into each row's model_in
+                for b, row in enumerate(rows):
+                    start_fill_idx, rel_start_fill_idx = start_fill_idxs[b], rel_start_fill_idxs[b]
+                    fill_end_idx = start_fill_idx + (1024 - rel_start_fill_idx)
+                    in_arrs[row][start_fill_idx:fill_end_idx, n_coarses[row] :] = in_buffer[
+                        b, rel_start_fill_idx:, n_coarses[row] :
+                    ]
+                del in_buffer
+            for in_arr, (_, n_history, n_remove_from_end, _) in zip(in_arrs, preps):
+                gen_fine_arr = in_arr.detach().cpu().numpy().T[:, n_history:]
+                if n_remove_from_end > 0:
+                    gen_fine_arr = gen_fine_arr[:, :-n_remove_from_end]
+                gen_fine_arrs.append(gen_fine_arr)
+            del in_arrs
+    finally:
+        if _is_offloaded("fine"):
+            model_residency.release("fine")
+    for gen_fine_arr, x_coarse_gen in zip(gen_fine_arrs, x_coarse_gens):
+        assert gen_fine_arr.shape[-1] == x_coarse_gen.shape[-1]
+    _clear_cuda_cache()
+    return gen_fine_arrs
+
+
 def codec_decode(fine_tokens):
     """Turn quantized audio codes into audio array using encodec."""
     # load models if not yet exist
@@ -805,16 +1797,18 @@ def codec_decode(fine_tokens):
     if "codec" not in models:
         preload_models()
     model = models["codec"]
-    if OFFLOAD_CPU:
-        model.to(models_devices["codec"])
-    device = next(model.parameters()).device
-    arr = torch.from_numpy(fine_tokens)[None]
-    arr = arr.to(device)
-    arr = arr.transpose(0, 1)
-    emb = model.quantizer.decode(arr)
-    out = model.decoder(emb)
-    audio_arr = out.detach().cpu().numpy().squeeze()
-    del arr, emb, out
-    if OFFLOAD_CPU:
-        model.to("cpu")
+    if _is_offloaded("codec"):
+        model_residency.acquire("codec", model, models_devices["codec"])
+    try:
+        device = next(model.parameters()).device
+        arr = torch.from_numpy(fine_tokens)[None]
+        arr = arr.to(device)
+        arr = arr.transpose(0, 1)
+        emb = model.quantizer.decode(arr)
+        out = model.decoder(emb)
+        audio_arr = out.detach().cpu().numpy().squeeze()
+        del arr, emb, out
+    finally:
+        if _is_offloaded("codec"):
+            model_residency.release("codec")
     return audio_arr
@@ -20,6 +20,71 @@ class LayerNorm(nn.Module):
     def forward(self, input):
         return F.layer_norm(input, self.weight.shape, self.weight, self.bias, 1e-5)
 
+class KVCache:
+    """
+    Preallocated key/value buffers for every layer of a GPT. New keys and values are written in
+    place at the current length instead of being concatenated onto the cache on every step, so
+    decoding does not reallocate and copy the whole cache per token.
+    Pass it as `past_kv` to `GPT.forward`, which advances `length` by the tokens it wrote.
+    """
+
+    def __init__(self, config, batch_size=1, max_len=None):
+        self.n_layer = config.n_layer
+        self.n_head = config.n_head
+        self.head_dim = config.n_embd // config.n_head
+        self.batch_size = batch_size
+        self.max_len = max_len or config.block_size
+        self.length = 0
+        # allocated on first use so they match the device and (autocast) dtype of the keys
+        self.k = None
+        self.v = None
+
+    def _allocate(self, like):
+        shape = (self.n_layer, self.batch_size, self.n_head, self.max_len, self.head_dim)
+        # zeroed, `GPT.decode_step` reads the unwritten slots too, and a nan or inf in a masked
+        # slot would still turn its output into nan
+        self.k = torch.zeros(shape, dtype=like.dtype, device=like.device)
+        self.v = torch.zeros(shape, dtype=like.dtype, device=like.device)
+
+    def update(self, layer_idx, k, v):
+        if self.k is None:
+            self._allocate(k)
+        end = self.length + k.shape[-2]
+        assert end <= self.max_len, f"kv cache is full, max_len is only {self.max_len}"
+        self.k[layer_idx, :, :, self.length:end] = k
+        self.v[layer_idx, :, :, self.length:end] = v
+        return self.k[layer_idx, :, :, :end], self.v[layer_idx, :, :, :end]
+
+    def reset(self):
+        self.length = 0
+
+    def select_rows(self, rows):
+        """Keep only `rows` (index tensor or bool mask) of the batch."""
+        if self.k is not None:
+            self.k = self.k[:, rows]
+            self.v = self.v[:, rows]
+            self.batch_size = self.k.shape[1]
+        else:
+            self.batch_size = torch.arange(self.batch_size)[rows.cpu()].numel()
+        return self
+
+    def snapshot(self):
+        """Copy of the filled part as a tuple of per layer (k, v), see `load`."""
+        return tuple(
+            (self.k[i, :, :, :self.length].clone(), self.v[i, :, :, :self.length].clone())
+            for i in range(self.n_layer)
+        )
+
+    def load(self, kv):
+        """Overwrite the cache with a tuple of per layer (k, v) such as returned by `snapshot`."""
+        if self.k is None:
+            self._allocate(kv[0][0])
+        self.length = kv[0][0].shape[-2]
+        for i, (k, v) in enumerate(kv):
+            self.k[i, :, :, :self.length] = k
+            self.v[i, :, :, :self.length] = v
+        return self
+
 class CausalSelfAttention(nn.Module):
 
     def __init__(self, config):
@@ -43,7 +108,7 @@ class CausalSelfAttention(nn.Module):
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x, past_kv=None, use_cache=False):
+    def forward(self, x, past_kv=None, use_cache=False, attn_mask=None, layer_idx=None):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -52,7 +117,9 @@ class CausalSelfAttention(nn.Module):
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
-        if past_kv is not None:
+        if isinstance(past_kv, KVCache):
+            k, v = past_kv.update(layer_idx, k, v)
+        elif past_kv is not None:
             past_key = past_kv[0]
             past_value = past_kv[1]
             k = torch.cat((past_key, k), dim=-2)
@@ -61,14 +128,26 @@ class CausalSelfAttention(nn.Module):
         FULL_T = k.shape[-2]
 
         if use_cache is True:
-            present = (k, v)
+            present = past_kv if isinstance(past_kv, KVCache) else (k, v)
         else:
             present = None
 
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        if self.flash:
+        if attn_mask is not None:
+            # padded batch: `attn_mask` (B, 1, T, FULL_T) already combines causal and padding masks
+            if self.flash:
+                y = torch.nn.functional.scaled_dot_product_attention(
+                    q, k, v, attn_mask=attn_mask, dropout_p=self.dropout, is_causal=False
+                )
+            else:
+                att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+                att = att.masked_fill(~attn_mask, float('-inf'))
+                att = F.softmax(att, dim=-1)
+                att = self.attn_dropout(att)
+                y = att @ v
+        elif self.flash:
             # efficient attention using Flash Attention CUDA kernels
-            if past_kv is not None:
+            if FULL_T > T:
                 # When `past_kv` is provided, we're doing incremental decoding and `q.shape[2] == 1`: q only contains
                 # the query for the last token. scaled_dot_product_attention interprets this as the first token in the
                 # sequence, so if is_causal=True it will mask out all attention from it. This is not what we want, so 
@@ -91,6 +170,34 @@ class CausalSelfAttention(nn.Module):
         y = self.resid_dropout(self.c_proj(y))
         return (y, present)
 
+    def decode_step(self, x, k_cache, v_cache, pos, key_mask):
+        """Attention of one new token with shapes that do not change from step to step.
+
+        The token's key and value are written into the `(B, nh, max_len, hs)` caches at `pos`, a
+        one element tensor, and it attends over the whole cache with `key_mask` hiding the slots
+        past `pos`. Nothing depends on the python side cache length, so this can be compiled once.
+        """
+        B, T, C = x.size()
+        q, k, v = self.c_attn(x).split(self.n_embd, dim=2)
+        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
+        q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
+        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
+        k_cache.index_copy_(2, pos, k.to(k_cache.dtype))
+        v_cache.index_copy_(2, pos, v.to(v_cache.dtype))
+        # the slots past `pos` are masked out, they hold zeros or stale keys and values, both
+        # finite, see `KVCache._allocate`
+        if self.flash:
+            y = torch.nn.functional.scaled_dot_product_attention(
+                q, k_cache.to(q.dtype), v_cache.to(q.dtype), attn_mask=key_mask
+            )
+        else:
+            att = (q @ k_cache.transpose(-2, -1).to(q.dtype)) * (1.0 / math.sqrt(k.size(-1)))
+            att = att.masked_fill(~key_mask, float('-inf'))
+            att = F.softmax(att, dim=-1)
+            y = att @ v_cache.to(q.dtype)
+        y = y.transpose(1, 2).contiguous().view(B, T, C)
+        return self.c_proj(y)
+
 class MLP(nn.Module):
 
     def __init__(self, config):
@@ -117,12 +224,23 @@ class Block(nn.Module):
         self.mlp = MLP(config)
         self.layer_idx = layer_idx
 
-    def forward(self, x, past_kv=None, use_cache=False):
-        attn_output, prev_kvs = self.attn(self.ln_1(x), past_kv=past_kv, use_cache=use_cache)
+    def forward(self, x, past_kv=None, use_cache=False, attn_mask=None):
+        attn_output, prev_kvs = self.attn(
+            self.ln_1(x),
+            past_kv=past_kv,
+            use_cache=use_cache,
+            attn_mask=attn_mask,
+            layer_idx=self.layer_idx,
+        )
         x = x + attn_output
         x = x + self.mlp(self.ln_2(x))
         return (x, prev_kvs)
 
+    def decode_step(self, x, k_cache, v_cache, pos, key_mask):
+        x = x + self.attn.decode_step(self.ln_1(x), k_cache, v_cache, pos, key_mask)
+        x = x + self.mlp(self.ln_2(x))
+        return x
+
 @dataclass
 class GPTConfig:
     block_size: int = 1024
@@ -165,9 +283,29 @@ class GPT(nn.Module):
             n_params -= self.transformer.wpe.weight.numel()
         return n_params
 
-    def forward(self, idx, merge_context=False, past_kv=None, position_ids=None, use_cache=False):
+    def forward(
+        self,
+        idx,
+        merge_context=False,
+        past_kv=None,
+        position_ids=None,
+        use_cache=False,
+        attention_mask=None,
+    ):
+        """
+        `past_kv` is either the tuple of per layer (k, v) returned by a previous call, or a
+        `KVCache` that is written in place (and returned as the new cache).
+
+        `attention_mask` is an optional (b, past_length + t) tensor that is 1 for real tokens and 0
+        for left padding, used to run rows of different lengths in one batch. When given, position
+        ids are counted over the unpadded tokens of each row.
+        """
         device = idx.device
         b, t = idx.size()
+        static_kv = past_kv if isinstance(past_kv, KVCache) else None
+        if static_kv is not None and static_kv.length == 0:
+            # empty static cache: this is the prefill
+            past_kv = None
         if past_kv is not None:
             assert t == 1
             tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
@@ -187,12 +325,28 @@ class GPT(nn.Module):
             else:
                 tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
 
-        if past_kv is None:
+        if static_kv is not None:
+            past_length = static_kv.length
+            past_kv = tuple([static_kv] * len(self.transformer.h))
+        elif past_kv is None:
             past_length = 0
             past_kv = tuple([None] * len(self.transformer.h))
         else:
             past_length = past_kv[0][0].size(-2)
 
+        attn_mask = None
+        if attention_mask is not None:
+            attention_mask = attention_mask.bool()
+            full_t = attention_mask.shape[1]
+            assert full_t == past_length + t
+            if position_ids is None:
+                position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)[:, -t:]
+            key_idx = torch.arange(full_t, device=device)
+            query_idx = key_idx[past_length:, None]
+            # padded queries may still attend to themselves so no row of the mask is empty
+            attn_mask = ((key_idx <= query_idx) & attention_mask[:, None, :]) | (key_idx == query_idx)
+            attn_mask = attn_mask[:, None]  # (b, 1, t, full_t)
+
         if position_ids is None:
             position_ids = torch.arange(past_length, t + past_length, dtype=torch.long, device=device)
             position_ids = position_ids.unsqueeze(0) # shape (1, t)
@@ -205,14 +359,35 @@ class GPT(nn.Module):
         new_kv = () if use_cache else None
 
         for i, (block, past_layer_kv) in enumerate(zip(self.transformer.h, past_kv)):
-            x, kv = block(x, past_kv=past_layer_kv, use_cache=use_cache)
+            x, kv = block(x, past_kv=past_layer_kv, use_cache=use_cache, attn_mask=attn_mask)
 
             if use_cache:
                 new_kv = new_kv + (kv,)
 
+        if static_kv is not None:
+            static_kv.length += t
+            new_kv = static_kv if use_cache else None
+
         x = self.transformer.ln_f(x)
 
         # inference-time mini-optimization: only forward the lm_head on the very last position
         logits = self.lm_head(x[:, [-1], :]) # note: using list [-1] to preserve the time dim
 
         return (logits, new_kv)
+
+    def decode_step(self, idx, k_cache, v_cache, pos):
+        """Logits of one decode step, the fixed shape counterpart of `forward` with a `KVCache`.
+
+        `idx` is the `(b, 1)` new token, `k_cache` and `v_cache` are the buffers of a filled
+        `KVCache` and `pos` is a one element long tensor holding its length. The cache is written
+        in place, the caller advances `KVCache.length`. Every shape stays the same over a whole
+        generation, which makes this the step to hand to `torch.compile`.
+        """
+        tok_emb = self.transformer.wte(idx)
+        pos_emb = self.transformer.wpe(pos.view(1, 1))
+        x = self.transformer.drop(tok_emb + pos_emb)
+        key_mask = torch.arange(k_cache.shape[-2], device=idx.device) <= pos
+        for i, block in enumerate(self.transformer.h):
+            x = block.decode_step(x, k_cache[i], v_cache[i], pos, key_mask)
+        x = self.transformer.ln_f(x)
+        return self.lm_head(x)
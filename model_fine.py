@@ -101,7 +101,11 @@ class FineGPT(GPT):
                 for _ in range(config.n_codes_given, self.n_codes_total)
             ]
         )
-        for i in range(self.n_codes_total - config.n_codes_given):
+        self.tie_weights()
+
+    def tie_weights(self):
+        """Shares the weight of each lm head with the embedding of the following codebook."""
+        for i in range(self.n_codes_total - self.config.n_codes_given):
             self.transformer.wtes[i + 1].weight = self.lm_heads[i].weight
 
     def forward(self, pred_idx, idx):
@@ -0,0 +1,89 @@
+"""Render many texts in parallel worker processes on a CPU-only machine.
+
+Batch size 1 decoding of the small models does not keep many cores busy from one process, so
+the texts are sharded over worker processes with a few torch threads each. The models are
+loaded once in the parent and the workers are forked from it, so all of them read the same
+copy-on-write weight pages instead of holding a copy each. Where fork is not available, or
+CUDA is, the workers are spawned and load the models themselves: a child forked from a process
+that initialized CUDA dies as soon as it touches CUDA again.
+"""
+import multiprocessing
+import os
+from typing import Dict, Iterable, Iterator, Optional, Union
+
+import torch
+
+from .api import generate_audio
+from .generation import preload_models
+
+# torch intra-op threads of each worker process
+WORKER_THREADS = int(os.environ.get("SUNO_WORKER_THREADS", "4"))
+
+
+def _init_worker(n_threads, load_models):
+    torch.set_num_threads(n_threads)
+    if load_models:
+        _preload_cpu_models()
+
+
+def _preload_cpu_models():
+    preload_models(
+        text_use_gpu=False, coarse_use_gpu=False, fine_use_gpu=False, codec_use_gpu=False
+    )
+
+
+def _render(args):
+    text, history_prompt, text_temp, waveform_temp, seed = args
+    return generate_audio(
+        text,
+        history_prompt=history_prompt,
+        text_temp=text_temp,
+        waveform_temp=waveform_temp,
+        silent=True,
+        seed=seed,
+    )
+
+
+def generate_audio_parallel(
+    texts: Iterable[str],
+    history_prompt: Optional[Union[Dict, str]] = None,
+    text_temp: float = 0.7,
+    waveform_temp: float = 0.7,
+    seed: Optional[int] = None,
+    n_workers: Optional[int] = None,
+    threads_per_worker: int = WORKER_THREADS,
+) -> Iterator:
+    """Generate audio for each of `texts` in `n_workers` processes, yielded in input order.
+
+    The workers render on the cpu. They are forked from this process, sharing its weights, only
+    on machines without CUDA, otherwise they are spawned.
+
+    Args:
+        texts: texts to be turned into audio, may be a lazy iterable
+        history_prompt: history choice for audio cloning
+        text_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        waveform_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        seed: seed for sampling, text `i` is rendered with seed `seed + i`
+        n_workers: worker processes, by default as many as fit `threads_per_worker` in the cores
+        threads_per_worker: torch threads of each worker
+
+    Yields:
+        numpy audio arrays at sample frequency 24khz
+    """
+    assert threads_per_worker > 0
+    if n_workers is None:
+        n_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+    use_fork = "fork" in multiprocessing.get_all_start_methods() and not torch.cuda.is_available()
+    if use_fork:
+        # loaded before forking, so the workers share the weights
+        _preload_cpu_models()
+    ctx = multiprocessing.get_context("fork" if use_fork else "spawn")
+    tasks = (
+        (text, history_prompt, text_temp, waveform_temp, None if seed is None else seed + i)
+        for i, text in enumerate(texts)
+    )
+    with ctx.Pool(
+        n_workers, initializer=_init_worker, initargs=(threads_per_worker, not use_fork)
+    ) as pool:
+        for audio_arr in pool.imap(_render, tasks):
+            yield audio_arr
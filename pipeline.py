@@ -0,0 +1,207 @@
+"""Run the generation stages of consecutive texts concurrently.
+
+Each stage (text to semantic, coarse, fine, codec decode) gets its own worker thread, joined by
+bounded queues. While text N is in the coarse model, text N + 1 is already in the text model
+and text N - 1 in the fine model. Torch releases the GIL inside its kernels, so the stages
+overlap on a multi-core CPU, and a CPU-side codec overlaps with the GPU stages.
+"""
+import contextlib
+import queue
+import threading
+from typing import Dict, Iterable, Iterator, Optional, Union
+
+import torch
+
+from .api import text_to_semantic
+from .generation import (
+    InferenceContext,
+    codec_decode,
+    generate_coarse,
+    generate_fine,
+    models,
+    models_devices,
+    preload_models,
+)
+from .render_cache import ENABLE_RENDER_CACHE, load_render, render_key, save_render
+from .streaming import is_layer_streamed
+
+# texts waiting between two stages, bounds the memory of generated but unconsumed tokens
+PIPELINE_QUEUE_SIZE = 2
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def _stage_device(model_key):
+    # offloaded models wait on the cpu but run on the device they were loaded for
+    if model_key in models_devices:
+        return torch.device(models_devices[model_key])
+    model = models[model_key]["model"] if model_key == "text" else models[model_key]
+    if is_layer_streamed(model):
+        return model._layer_streamer.device
+    return next(model.parameters()).device
+
+
+def _stage_stream(device):
+    # a side stream per gpu stage thread so gpu stages do not serialize on the default stream,
+    # results leave the stage as numpy arrays so the copy back synchronizes the stream
+    if device.type == "cuda":
+        return torch.cuda.stream(torch.cuda.Stream(device))
+    return contextlib.nullcontext()
+
+
+def _run_stage(fn, device, in_queue, out_queue, stop):
+    with _stage_stream(device):
+        while True:
+            item = _get(in_queue, stop)
+            if item is _DONE or isinstance(item, _Failure):
+                _put(out_queue, item, stop)
+                return
+            try:
+                if "audio" not in item:
+                    fn(item)
+            except BaseException as exc:
+                _put(out_queue, _Failure(exc), stop)
+                return
+            if not _put(out_queue, item, stop):
+                return
+
+
+def generate_audio_pipelined(
+    texts: Iterable[str],
+    history_prompt: Optional[Union[Dict, str]] = None,
+    text_temp: float = 0.7,
+    waveform_temp: float = 0.7,
+    output_full: bool = False,
+    seed: Optional[int] = None,
+    queue_size: int = PIPELINE_QUEUE_SIZE,
+) -> Iterator:
+    """Generate audio for each of `texts`, running the stages of consecutive texts concurrently.
+
+    Every text is rendered exactly as `generate_audio` would render it, and the results are
+    yielded in the order of `texts`. Closing the generator early stops the workers.
+
+    Args:
+        texts: texts to be turned into audio, may be a lazy iterable
+        history_prompt: history choice for audio cloning
+        text_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        waveform_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        output_full: yield `(full_generation, audio_arr)` instead of the audio array
+        seed: seed for sampling, text `i` is rendered with seed `seed + i`
+        queue_size: texts buffered between two consecutive stages
+
+    Yields:
+        numpy audio arrays at sample frequency 24khz
+    """
+    assert queue_size > 0
+    # load the models up front, the stage threads would otherwise race to load them
+    if any(model_key not in models for model_key in ("text", "coarse", "fine", "codec")):
+        preload_models()
+
+    def semantic_stage(item):
+        if item["seed"] is not None and ENABLE_RENDER_CACHE:
+            item["cache_key"] = render_key(
+                item["text"], history_prompt, text_temp, waveform_temp, item["seed"]
+            )
+            cached = load_render(item["cache_key"])
+            if cached is not None:
+                item["full_generation"], item["audio"] = cached
+                return
+        item["semantic_prompt"] = text_to_semantic(
+            item["text"],
+            history_prompt=history_prompt,
+            temp=text_temp,
+            silent=True,
+            seed=item["seed"],
+        )
+
+    def coarse_stage(item):
+        item["coarse_prompt"] = generate_coarse(
+            item["semantic_prompt"],
+            history_prompt=history_prompt,
+            temp=waveform_temp,
+            silent=True,
+            use_kv_caching=True,
+            seed=item["seed"],
+        )
+
+    def fine_stage(item):
+        item["fine_prompt"] = generate_fine(
+            item["coarse_prompt"], history_prompt=history_prompt, temp=0.5, seed=item["seed"]
+        )
+
+    def codec_stage(item):
+        item["full_generation"] = {
+            "semantic_prompt": item.pop("semantic_prompt"),
+            "coarse_prompt": item.pop("coarse_prompt"),
+            "fine_prompt": item.pop("fine_prompt"),
+        }
+        item["audio"] = codec_decode(item["full_generation"]["fine_prompt"])
+        if item.get("cache_key") is not None:
+            save_render(item["cache_key"], item["full_generation"], item["audio"])
+
+    stop = threading.Event()
+    stages = [semantic_stage, coarse_stage, fine_stage, codec_stage]
+    devices = [_stage_device(model_key) for model_key in ("text", "coarse", "fine", "codec")]
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    def feed():
+        try:
+            for i, text in enumerate(texts):
+                item = {"text": text, "seed": None if seed is None else seed + i}
+                if not _put(queues[0], item, stop):
+                    return
+        except BaseException as exc:
+            _put(queues[0], _Failure(exc), stop)
+            return
+        _put(queues[0], _DONE, stop)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for stage, device, in_queue, out_queue in zip(stages, devices, queues[:-1], queues[1:]):
+        threads.append(
+            threading.Thread(
+                target=_run_stage, args=(stage, device, in_queue, out_queue, stop), daemon=True
+            )
+        )
+    # the cudnn flag is set once for all stages, the contexts the stages enter only nest in it
+    with InferenceContext():
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = _get(queues[-1], stop)
+                if item is _DONE:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.exc
+                if output_full:
+                    yield item["full_generation"], item["audio"]
+                else:
+                    yield item["audio"]
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
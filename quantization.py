@@ -0,0 +1,55 @@
+import torch
+import torch.nn as nn
+
+from .model import CausalSelfAttention, MLP
+from .model_fine import NonCausalSelfAttention
+
+# the linears of these modules are quantized, the embeddings and lm heads stay in float
+QUANTIZED_MODULES = (CausalSelfAttention, MLP, NonCausalSelfAttention)
+
+SUPPORTED_QUANTIZATIONS = ("int8",)
+
+
+def _quantized_linear_names(model):
+    names = []
+    for module_name, module in model.named_modules():
+        if not isinstance(module, QUANTIZED_MODULES):
+            continue
+        for child_name, child in module.named_children():
+            if isinstance(child, nn.Linear):
+                names.append(f"{module_name}.{child_name}")
+    return names
+
+
+def quantize_int8(model):
+    """Quantize the attention and mlp linears of `model` to int8 in place, for the cpu.
+
+    Weights are quantized once, activations dynamically per call.
+    """
+    torch.ao.quantization.quantize_dynamic(
+        model, set(_quantized_linear_names(model)), dtype=torch.qint8, inplace=True
+    )
+    return model
+
+
+def int8_skeleton(model):
+    """Replace the linears `quantize_int8` would quantize with empty int8 ones, in place.
+
+    Used to load a state dict saved from a quantized model without quantizing anything. Works on
+    a model built on the meta device.
+    """
+    for name in _quantized_linear_names(model):
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name)
+        linear = getattr(parent, child_name)
+        setattr(
+            parent,
+            child_name,
+            torch.ao.nn.quantized.dynamic.Linear(
+                linear.in_features,
+                linear.out_features,
+                bias_=linear.bias is not None,
+                dtype=torch.qint8,
+            ),
+        )
+    return model
@@ -0,0 +1,226 @@
+"""Content addressed on-disk cache of rendered audio.
+
+A render is stored under the hash of everything that determines it: the normalized text, the
+history prompt contents, the temperatures, the seed and the checkpoints in use. Only seeded
+renders are cached, unseeded ones are meant to come out different on every call.
+
+Semantic tokens get their own tier keyed only by what the text model sees, so changing the
+waveform temperature reruns the coarse, fine and codec stages but not the text model.
+"""
+import hashlib
+import json
+import logging
+import os
+import zipfile
+
+import numpy as np
+
+from .generation import (
+    CACHE_DIR,
+    COMPUTE_DTYPE,
+    QUANTIZE,
+    STORAGE_DTYPE,
+    _cast_bool_env_var,
+    _load_history_prompt,
+    _model_variant,
+    _normalize_whitespace,
+    _write_atomic,
+)
+
+logger = logging.getLogger(__name__)
+
+
+RENDER_CACHE_DIR = os.path.join(CACHE_DIR, "renders")
+ENABLE_RENDER_CACHE = _cast_bool_env_var(os.environ.get("SUNO_ENABLE_RENDER_CACHE", "True"))
+# least recently used renders are evicted once the cache grows past this size
+RENDER_CACHE_MAX_MB = int(os.environ.get("SUNO_RENDER_CACHE_MAX_MB", "2048"))
+# bump when the generation code changes in a way that changes outputs for the same key
+RENDER_CACHE_VERSION = 1
+# encodec is always run at this bandwidth, see `_load_codec_model`
+CODEC_BANDWIDTH = 6.0
+
+# running size of the cache in bytes, None until the first scan. Entries written by other
+# processes are only counted at the next scan, which happens when this crosses the budget.
+_cache_bytes = None
+
+
+def _history_prompt_hash(history_prompt):
+    if history_prompt is None:
+        return None
+    history_prompt = _load_history_prompt(history_prompt)
+    h = hashlib.sha256()
+    for key in ("semantic_prompt", "coarse_prompt", "fine_prompt"):
+        arr = np.ascontiguousarray(history_prompt[key])
+        h.update(f"{key}:{arr.dtype}:{arr.shape}".encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def _add_precision(payload):
+    # reduced precision models sample different tokens, float32 keys stay as they were
+    if QUANTIZE is not None:
+        payload["quantize"] = QUANTIZE
+    if STORAGE_DTYPE is not None:
+        payload["dtypes"] = [STORAGE_DTYPE, COMPUTE_DTYPE]
+
+
+def render_key(text, history_prompt, text_temp, waveform_temp, seed):
+    """Cache key of `generate_audio(text, history_prompt, text_temp, waveform_temp, seed=seed)`."""
+    assert seed is not None
+    payload = {
+        "version": RENDER_CACHE_VERSION,
+        "text": _normalize_whitespace(text),
+        "history_prompt": _history_prompt_hash(history_prompt),
+        "text_temp": text_temp,
+        "waveform_temp": waveform_temp,
+        "seed": int(seed),
+        "models": [_model_variant(model_type) for model_type in ("text", "coarse", "fine")],
+        "codec_bandwidth": CODEC_BANDWIDTH,
+    }
+    _add_precision(payload)
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def semantic_key(text, history_prompt, temp, seed):
+    """Cache key of `text_to_semantic(text, history_prompt, temp, seed=seed)`."""
+    assert seed is not None
+    payload = {
+        "version": RENDER_CACHE_VERSION,
+        "text": _normalize_whitespace(text),
+        "history_prompt": _history_prompt_hash(history_prompt),
+        "temp": temp,
+        "seed": int(seed),
+        "model": _model_variant("text"),
+    }
+    _add_precision(payload)
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _render_path(key):
+    return os.path.join(RENDER_CACHE_DIR, key[:2], f"{key}.npz")
+
+
+def _semantic_path(key):
+    return os.path.join(RENDER_CACHE_DIR, "semantic", key[:2], f"{key}.npy")
+
+
+def load_render(key):
+    """Returns `(full_generation, audio_arr)` stored under `key`, or None on a miss."""
+    path = _render_path(key)
+    try:
+        with np.load(path) as data:
+            full_generation = {
+                "semantic_prompt": data["semantic_prompt"],
+                "coarse_prompt": data["coarse_prompt"],
+                "fine_prompt": data["fine_prompt"],
+            }
+            audio_arr = data["audio"]
+    except FileNotFoundError:
+        return None
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        logger.warning(f"dropping unreadable render cache entry `{path}`")
+        _remove(path)
+        return None
+    _touch(path)
+    return full_generation, audio_arr
+
+
+def save_render(key, full_generation, audio_arr):
+    """Stores a render under `key`, then evicts old renders if the cache is over budget."""
+    _write_atomic(
+        _render_path(key),
+        lambda f: np.savez(
+            f,
+            semantic_prompt=full_generation["semantic_prompt"],
+            coarse_prompt=full_generation["coarse_prompt"],
+            fine_prompt=full_generation["fine_prompt"],
+            audio=audio_arr,
+        ),
+    )
+    _count_saved(_render_path(key))
+
+
+def load_semantic(key):
+    """Returns the semantic tokens stored under `key`, or None on a miss."""
+    path = _semantic_path(key)
+    try:
+        semantic_tokens = np.load(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        logger.warning(f"dropping unreadable semantic cache entry `{path}`")
+        _remove(path)
+        return None
+    _touch(path)
+    return semantic_tokens.astype(np.int64)
+
+
+def save_semantic(key, semantic_tokens):
+    """Stores semantic tokens under `key` as int16, the vocab size fits in 15 bits."""
+    assert semantic_tokens.max(initial=0) < np.iinfo(np.int16).max
+    _write_atomic(_semantic_path(key), lambda f: np.save(f, semantic_tokens.astype(np.int16)))
+    _count_saved(_semantic_path(key))
+
+
+def _count_saved(path):
+    # adds a saved entry to the running size and scans the cache only once it is over budget
+    global _cache_bytes
+    if _cache_bytes is None:
+        evict_renders()
+        return
+    try:
+        _cache_bytes += os.path.getsize(path)
+    except FileNotFoundError:
+        return
+    if _cache_bytes > RENDER_CACHE_MAX_MB * 1024 * 1024:
+        evict_renders()
+
+
+def _touch(path):
+    # the mtime is the lru clock, another process may have just evicted the entry
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _list_renders():
+    entries = []
+    if not os.path.isdir(RENDER_CACHE_DIR):
+        return entries
+    for root, _, file_names in os.walk(RENDER_CACHE_DIR):
+        for file_name in file_names:
+            if not file_name.endswith((".npz", ".npy")):
+                continue
+            path = os.path.join(root, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+
+def evict_renders(max_mb=None):
+    """Removes least recently used entries of both tiers until they fit in `max_mb` megabytes."""
+    global _cache_bytes
+    max_bytes = (RENDER_CACHE_MAX_MB if max_mb is None else max_mb) * 1024 * 1024
+    entries = _list_renders()
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        _remove(path)
+        total_bytes -= size
+    _cache_bytes = total_bytes
+
+
+def clear_render_cache():
+    evict_renders(max_mb=0)
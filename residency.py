@@ -0,0 +1,117 @@
+import collections
+import logging
+import threading
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def module_bytes(module):
+    """Bytes held by the parameters and buffers of `module`, shared tensors counted once."""
+    seen = set()
+    total = 0
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        if tensor.device.type == "meta":
+            continue
+        key = (tensor.untyped_storage().data_ptr(), tensor.device)
+        if key in seen:
+            continue
+        seen.add(key)
+        total += tensor.untyped_storage().nbytes()
+    return total
+
+
+class ModelResidency:
+    """Keeps offloaded models on their device between calls while they fit into a budget.
+
+    Models live on the cpu and are moved to their device by `acquire`. `release` leaves them
+    there while the models resident on that device fit into `budget_bytes`, so consecutive calls
+    of the same stage do not move any weights. Otherwise idle models are moved back to the cpu,
+    least recently used first. Models in use are never evicted, if they alone exceed the budget
+    the acquired model is moved in anyway.
+
+    Args:
+        budget_bytes: bytes of model weights that may stay resident per device. The default of
+            0 moves every model back to the cpu as soon as it is released.
+    """
+
+    def __init__(self, budget_bytes=0):
+        self.budget_bytes = budget_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_moved = 0
+        self._lock = threading.Lock()
+        # key -> (module, device, size), in least recently used order
+        self._resident = collections.OrderedDict()
+        self._in_use = collections.Counter()
+
+    def _evict_for(self, size, device):
+        budget = self.budget_bytes
+        used = sum(s for _, d, s in self._resident.values() if d == device)
+        for key in list(self._resident):
+            if used + size <= budget:
+                break
+            module, resident_device, resident_size = self._resident[key]
+            if resident_device != device or self._in_use[key] > 0:
+                continue
+            module.to("cpu")
+            del self._resident[key]
+            used -= resident_size
+            self.evictions += 1
+            self.bytes_moved += resident_size
+
+    def acquire(self, key, module, device):
+        """Moves `module` to `device` unless it is resident already, and marks it in use."""
+        device = torch.device(device)
+        with self._lock:
+            self._in_use[key] += 1
+            if key in self._resident and self._resident[key][1] == device:
+                self.hits += 1
+                self._resident.move_to_end(key)
+                return module
+            self.misses += 1
+            size = module_bytes(module)
+            self._resident.pop(key, None)
+            self._evict_for(size, device)
+            module.to(device)
+            self._resident[key] = (module, device, size)
+            self.bytes_moved += size
+            return module
+
+    def release(self, key):
+        """Marks the model under `key` as no longer in use, it stays on its device if in budget."""
+        with self._lock:
+            self._in_use[key] -= 1
+            if self._in_use[key] <= 0:
+                del self._in_use[key]
+            if key in self._resident:
+                self._evict_for(0, self._resident[key][1])
+
+    def forget(self, key):
+        """Drops the bookkeeping of `key`, for models that were moved or deleted elsewhere."""
+        with self._lock:
+            self._resident.pop(key, None)
+
+    def offload_all(self):
+        """Moves every idle resident model back to the cpu."""
+        with self._lock:
+            for key in list(self._resident):
+                if self._in_use[key] > 0:
+                    continue
+                module, _, size = self._resident.pop(key)
+                module.to("cpu")
+                self.evictions += 1
+                self.bytes_moved += size
+
+    def stats(self):
+        """Counters since creation: cache `hits`, `misses`, `evictions` and `bytes_moved`."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes_moved": self.bytes_moved,
+                "resident": list(self._resident),
+            }
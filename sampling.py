@@ -0,0 +1,84 @@
+import torch
+import torch.nn.functional as F
+
+
+def make_generators(seeds, device):
+    """One `torch.Generator` on `device` per seed, or None when `seeds` is None."""
+    if seeds is None:
+        return None
+    return [torch.Generator(device=device).manual_seed(int(seed)) for seed in seeds]
+
+
+class Sampler:
+    """Samples one token per row from `[B, V]` logits with temperature, top-k and top-p.
+
+    Everything stays on the logits' device, so sampling does not force a host sync per token.
+
+    Args:
+        temp: sampling temperature, either one float for all rows or one value per row
+        top_k: only sample among the `top_k` most likely tokens
+        top_p: only sample among the most likely tokens whose cumulative probability is `top_p`
+        generators: optional `torch.Generator` per row. Each row then draws its randomness from
+            its own generator only, so its output does not depend on the other rows of the batch.
+    """
+
+    def __init__(self, temp=0.7, top_k=None, top_p=None, generators=None):
+        self.temp = temp
+        self.top_k = top_k
+        self.top_p = top_p
+        self.generators = list(generators) if generators is not None else None
+        self._temp_rows = None
+
+    def _temp(self, logits):
+        if isinstance(self.temp, (int, float)):
+            return self.temp
+        if self._temp_rows is None or self._temp_rows.device != logits.device:
+            self._temp_rows = torch.as_tensor(
+                self.temp, dtype=torch.float32, device=logits.device
+            ).reshape(-1, 1)
+        return self._temp_rows
+
+    def select_rows(self, rows):
+        """Keep the per row state of `rows` (bool mask or index list) after rows were dropped."""
+        rows = torch.as_tensor(rows).cpu()
+        if rows.dtype == torch.bool:
+            rows = rows.nonzero()[:, 0]
+        rows = rows.tolist()
+        if not isinstance(self.temp, (int, float)):
+            self.temp = [self.temp[row] for row in rows]
+            self._temp_rows = None
+        if self.generators is not None:
+            self.generators = [self.generators[row] for row in rows]
+        return self
+
+    def __call__(self, relevant_logits):
+        """Returns `(item_next, probs)`: sampled `[B, 1]` int32 tokens and their distribution."""
+        if self.top_p is not None:
+            sorted_logits, sorted_indices = torch.sort(relevant_logits, descending=True, dim=-1)
+            cumulative_probs = torch.cumsum(F.softmax(sorted_logits.float(), dim=-1), dim=-1)
+            sorted_indices_to_remove = cumulative_probs > self.top_p
+            sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
+            sorted_indices_to_remove[:, 0] = False
+            indices_to_remove = sorted_indices_to_remove.scatter(
+                -1, sorted_indices, sorted_indices_to_remove
+            )
+            relevant_logits = relevant_logits.masked_fill(indices_to_remove, -float("Inf"))
+        if self.top_k is not None:
+            v, _ = torch.topk(relevant_logits, min(self.top_k, relevant_logits.size(-1)), dim=-1)
+            relevant_logits = relevant_logits.masked_fill(
+                relevant_logits < v[:, [-1]], -float("Inf")
+            )
+        probs = F.softmax(relevant_logits / self._temp(relevant_logits), dim=-1)
+        if self.generators is None:
+            item_next = torch.multinomial(probs, num_samples=1)
+        else:
+            assert len(self.generators) == probs.shape[0]
+            # inverse cdf sampling with one uniform draw per row from that row's generator
+            u = torch.cat([
+                torch.rand(1, generator=generator, device=generator.device)
+                for generator in self.generators
+            ]).to(probs.device)
+            cdf = torch.cumsum(probs.float(), dim=-1)
+            item_next = torch.searchsorted(cdf, (u * cdf[:, -1])[:, None], right=True)
+            item_next = item_next.clamp(max=probs.shape[-1] - 1)
+        return item_next.to(torch.int32), probs
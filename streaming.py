@@ -0,0 +1,126 @@
+"""Run GPT and FineGPT with their transformer blocks streamed from the cpu, one at a time.
+
+Only the embeddings, the final layer norm and the heads are kept on the device. The weights of
+each block stay in (pinned) cpu memory and are copied in right before the block runs. On CUDA
+the copy of the next block is started on a side stream while the current one computes, so the
+transfers overlap with the compute instead of stalling every block. The device then holds at
+most two blocks at a time.
+
+The hooks are accelerate's `ModelHook`, attached with `add_hook_to_module`, accelerate is only
+needed when this mode is used.
+"""
+import torch
+
+
+def _require_accelerate():
+    try:
+        from accelerate.hooks import ModelHook, add_hook_to_module
+    except ImportError as e:
+        raise ImportError(
+            "streaming transformer blocks needs accelerate, `pip install accelerate`"
+        ) from e
+    return ModelHook, add_hook_to_module
+
+
+def is_layer_streamed(model):
+    """Whether `stream_layers` was applied to `model`, it must not be moved with `.to` then."""
+    return getattr(model, "_layer_streamer", None) is not None
+
+
+class _BlockStreamer:
+    """Copies the weights of `blocks` between the cpu and `device`, one block ahead."""
+
+    def __init__(self, blocks, device):
+        self.blocks = list(blocks)
+        self.device = torch.device(device)
+        self.use_stream = self.device.type == "cuda"
+        self.stream = torch.cuda.Stream(self.device) if self.use_stream else None
+        # per block: its parameters and buffers by name, and the cpu data they hold when unloaded
+        self.tensors = []
+        self.cpu_data = []
+        for block in self.blocks:
+            tensors = dict(block.named_parameters())
+            tensors.update(dict(block.named_buffers()))
+            if self.use_stream:
+                # copies from pinned memory can run asynchronously
+                for tensor in tensors.values():
+                    tensor.data = tensor.data.pin_memory()
+            self.tensors.append(tensors)
+            self.cpu_data.append({name: tensor.data for name, tensor in tensors.items()})
+        # per block: (device data by name, event recorded once copied) while on the device
+        self.loaded = [None] * len(self.blocks)
+
+    def prefetch(self, idx):
+        if self.loaded[idx] is not None:
+            return
+        if not self.use_stream:
+            device_data = {name: data.to(self.device) for name, data in self.cpu_data[idx].items()}
+            self.loaded[idx] = (device_data, None)
+            return
+        with torch.cuda.stream(self.stream):
+            device_data = {
+                name: data.to(self.device, non_blocking=True)
+                for name, data in self.cpu_data[idx].items()
+            }
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.loaded[idx] = (device_data, event)
+
+    def load(self, idx):
+        self.prefetch(idx)
+        device_data, event = self.loaded[idx]
+        if event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            for data in device_data.values():
+                # allocated on the side stream, keep it alive until the compute stream is done
+                data.record_stream(current_stream)
+        for name, tensor in self.tensors[idx].items():
+            tensor.data = device_data[name]
+        # the block after the last is the first one of the next forward
+        self.prefetch((idx + 1) % len(self.blocks))
+
+    def unload(self, idx):
+        for name, tensor in self.tensors[idx].items():
+            tensor.data = self.cpu_data[idx][name]
+        self.loaded[idx] = None
+
+
+def stream_layers(model, device):
+    """Move `model` to `device` except for its transformer blocks, which are streamed in.
+
+    Args:
+        model: a `GPT` or `FineGPT`
+        device: device the model computes on
+
+    Returns:
+        `model`, changed in place
+    """
+    ModelHook, add_hook_to_module = _require_accelerate()
+
+    class StreamBlockHook(ModelHook):
+        def __init__(self, streamer, idx):
+            self.streamer = streamer
+            self.idx = idx
+
+        def pre_forward(self, module, *args, **kwargs):
+            self.streamer.load(self.idx)
+            return args, kwargs
+
+        def post_forward(self, module, output):
+            self.streamer.unload(self.idx)
+            return output
+
+    blocks = model.transformer.h
+    for name, child in model.named_children():
+        if name != "transformer":
+            child.to(device)
+    for name, child in model.transformer.named_children():
+        if name != "h":
+            child.to(device)
+    blocks.to("cpu")
+    streamer = _BlockStreamer(blocks, device)
+    for idx, block in enumerate(blocks):
+        add_hook_to_module(block, StreamBlockHook(streamer, idx))
+    model._layer_streamer = streamer
+    return model
@@ -0,0 +1,52 @@
+import copy
+
+import torch
+
+from bark.casting import apply_dtype_policy
+from bark.model import GPT, GPTConfig
+
+
+def small_model():
+    torch.manual_seed(0)
+    config = GPTConfig(
+        block_size=64, input_vocab_size=32, output_vocab_size=32, n_layer=2, n_head=2, n_embd=16
+    )
+    return GPT(config).eval()
+
+
+def test_only_the_running_layer_is_cast():
+    model = apply_dtype_policy(small_model(), torch.bfloat16, torch.float32)
+    seen = []
+
+    def check(module, args):
+        seen.append(module.weight.dtype)
+        # the other layers stay in the storage dtype meanwhile
+        assert model.lm_head.weight.dtype == torch.bfloat16
+
+    # pre hooks run in registration order, so this one sees the cast weights
+    model.transformer.h[0].attn.c_attn.register_forward_pre_hook(check)
+    with torch.no_grad():
+        model(torch.randint(0, 32, (1, 8)))
+    assert seen == [torch.float32]
+    assert all(param.dtype == torch.bfloat16 for param in model.parameters())
+
+
+def test_mixed_policy_matches_float_model_of_rounded_weights():
+    model = small_model()
+    expected_model = copy.deepcopy(model).to(torch.bfloat16).to(torch.float32)
+    apply_dtype_policy(model, torch.bfloat16, torch.float32)
+    x = torch.randint(0, 32, (1, 8))
+    with torch.no_grad():
+        logits, _ = model(x)
+        expected, _ = expected_model(x)
+    assert logits.dtype == torch.float32
+    torch.testing.assert_close(logits, expected)
+
+
+def test_equal_dtypes_convert_without_hooks():
+    model = apply_dtype_policy(small_model(), torch.bfloat16, torch.bfloat16)
+    assert all(param.dtype == torch.bfloat16 for param in model.parameters())
+    assert not model.lm_head._forward_pre_hooks
+    with torch.no_grad():
+        logits, _ = model(torch.randint(0, 32, (1, 8)))
+    assert logits.dtype == torch.bfloat16
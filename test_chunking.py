@@ -0,0 +1,92 @@
+from bark.chunking import chunk_text, split_sentences
+
+
+class WordTokenizer:
+    # one token per whitespace separated word
+    def __call__(self, texts, add_special_tokens=False):
+        return {"input_ids": [text.split() for text in texts]}
+
+
+class CharTokenizer:
+    # one token per character, like the text tokenizer on CJK text
+    def __call__(self, texts, add_special_tokens=False):
+        return {"input_ids": [list(text.replace(" ", "")) for text in texts]}
+
+
+def test_split_sentences():
+    assert split_sentences("Hello there.  How are\nyou? Fine!") == [
+        "Hello there.",
+        "How are you?",
+        "Fine!",
+    ]
+    assert split_sentences('He said "stop." Then left') == ['He said "stop."', "Then left"]
+    assert split_sentences("你好。再见！") == ["你好。", "再见！"]
+
+
+def test_empty_text_has_no_chunks():
+    assert chunk_text("", tokenizer=WordTokenizer()) == []
+    assert chunk_text(" \n\t ", tokenizer=WordTokenizer()) == []
+
+
+def test_short_sentences_are_merged():
+    text = "One two. Three four. Five six."
+    assert chunk_text(text, tokenizer=WordTokenizer()) == [text]
+
+
+def test_chunks_respect_max_tokens():
+    text = " ".join(f"Sentence number {i} is here." for i in range(20))
+    chunks = chunk_text(text, tokenizer=WordTokenizer(), max_tokens=12, max_duration_s=1000)
+    assert len(chunks) > 1
+    assert all(len(chunk.split()) <= 12 for chunk in chunks)
+    assert " ".join(chunks) == text
+    # sentences are kept whole
+    assert all(chunk.endswith(".") for chunk in chunks)
+
+
+def test_long_sentence_splits_at_clauses_then_words():
+    clause = "a b c d e f"
+    text = ", ".join([clause] * 4) + "."
+    chunks = chunk_text(text, tokenizer=WordTokenizer(), max_tokens=8, max_duration_s=1000)
+    assert all(len(chunk.split()) <= 8 for chunk in chunks)
+    assert chunks[0] == "a b c d e f,"
+    words = "w " * 30
+    chunks = chunk_text(words, tokenizer=WordTokenizer(), max_tokens=8, max_duration_s=1000)
+    assert [len(chunk.split()) for chunk in chunks] == [8, 8, 8, 6]
+
+
+def test_chunks_respect_estimated_duration():
+    text = " ".join(["word"] * 100)
+    chunks = chunk_text(text, tokenizer=WordTokenizer(), max_duration_s=2, chars_per_second=14)
+    assert all(len(chunk) <= 28 for chunk in chunks)
+    assert " ".join(chunks) == text
+
+
+def test_text_without_spaces_is_cut_by_characters():
+    text = "字" * 1000
+    chunks = chunk_text(text, tokenizer=CharTokenizer(), max_duration_s=14, chars_per_second=14)
+    assert all(len(chunk) <= 196 for chunk in chunks)
+    assert "".join(chunks) == text
+
+
+def test_character_cut_is_halved_until_tokens_fit():
+    text = "a" * 50
+    chunks = chunk_text(text, tokenizer=CharTokenizer(), max_tokens=10, max_duration_s=1000)
+    assert all(len(chunk) <= 10 for chunk in chunks)
+    assert "".join(chunks) == text
+
+
+def test_cjk_sentences_are_merged_without_spaces():
+    assert chunk_text("你好。再见！", tokenizer=CharTokenizer()) == ["你好。再见！"]
+    assert chunk_text("こんにちは。 さようなら。", tokenizer=CharTokenizer()) == [
+        "こんにちは。さようなら。"
+    ]
+    # a space stays where cjk text meets other scripts
+    assert chunk_text("你好。Hello there.", tokenizer=CharTokenizer()) == ["你好。 Hello there."]
+
+
+def test_cjk_character_cuts_are_merged_without_spaces():
+    text = "字" * 12 + "。" + "好" * 3
+    chunks = chunk_text(text, tokenizer=CharTokenizer(), max_tokens=10, max_duration_s=1000)
+    assert all(len(chunk) <= 10 for chunk in chunks)
+    assert "".join(chunks) == text
+    assert not any(" " in chunk for chunk in chunks)
@@ -0,0 +1,95 @@
+import torch
+
+from bark.model import GPT, GPTConfig, KVCache
+
+
+def small_config():
+    return GPTConfig(
+        block_size=64, input_vocab_size=32, output_vocab_size=32, n_layer=2, n_head=2, n_embd=16
+    )
+
+
+def test_kv_cache_update_writes_in_place():
+    config = small_config()
+    kv_cache = KVCache(config, batch_size=2, max_len=8)
+    k = torch.randn(2, 2, 3, 8)
+    v = torch.randn(2, 2, 3, 8)
+    k_out, v_out = kv_cache.update(0, k, v)
+    assert torch.equal(k_out, k) and torch.equal(v_out, v)
+    kv_cache.length += 3
+    k_next = torch.randn(2, 2, 1, 8)
+    k_out, _ = kv_cache.update(0, k_next, torch.randn(2, 2, 1, 8))
+    assert k_out.shape == (2, 2, 4, 8)
+    assert torch.equal(k_out[:, :, :3], k)
+    assert torch.equal(k_out[:, :, 3:], k_next)
+    # written into the preallocated buffer, not a new tensor
+    assert k_out.data_ptr() == kv_cache.k[0].data_ptr()
+
+
+def test_kv_cache_reset_rewinds_length():
+    config = small_config()
+    kv_cache = KVCache(config, max_len=8)
+    kv_cache.update(0, torch.randn(1, 2, 5, 8), torch.randn(1, 2, 5, 8))
+    kv_cache.length = 5
+    buffer = kv_cache.k
+    kv_cache.reset()
+    assert kv_cache.length == 0
+    assert kv_cache.k is buffer
+    k = torch.randn(1, 2, 2, 8)
+    k_out, _ = kv_cache.update(0, k, torch.randn(1, 2, 2, 8))
+    assert torch.equal(k_out, k)
+
+
+def test_kv_cache_select_rows():
+    config = small_config()
+    kv_cache = KVCache(config, batch_size=3, max_len=8)
+    k = torch.randn(3, 2, 2, 8)
+    kv_cache.update(1, k, torch.randn(3, 2, 2, 8))
+    kv_cache.length = 2
+    kv_cache.select_rows(torch.tensor([True, False, True]))
+    assert kv_cache.batch_size == 2
+    assert torch.equal(kv_cache.k[1, :, :, :2], k[[0, 2]])
+
+
+def test_kv_cache_select_rows_before_allocation():
+    kv_cache = KVCache(small_config(), batch_size=4)
+    kv_cache.select_rows(torch.tensor([0, 3]))
+    assert kv_cache.batch_size == 2
+    assert kv_cache.k is None
+
+
+def test_static_kv_cache_matches_tuple_cache():
+    torch.manual_seed(0)
+    model = GPT(small_config()).eval()
+    x = torch.randint(0, 32, (1, 10))
+    with torch.no_grad():
+        _, tuple_kv = model(x[:, :9], use_cache=True)
+        expected, _ = model(x[:, 9:], use_cache=True, past_kv=tuple_kv)
+        kv_cache = KVCache(model.config)
+        _, kv_cache = model(x[:, :9], use_cache=True, past_kv=kv_cache)
+        logits, kv_cache = model(x[:, 9:], use_cache=True, past_kv=kv_cache)
+    assert kv_cache.length == 10
+    torch.testing.assert_close(logits, expected)
+
+
+def test_kv_cache_is_allocated_zeroed():
+    kv_cache = KVCache(small_config(), max_len=8)
+    kv_cache.update(0, torch.randn(1, 2, 3, 8), torch.randn(1, 2, 3, 8))
+    assert torch.all(kv_cache.k[:, :, :, 3:] == 0) and torch.all(kv_cache.v[1] == 0)
+
+
+def test_decode_step_matches_forward_on_a_reused_cache():
+    torch.manual_seed(0)
+    model = GPT(small_config()).eval()
+    x = torch.randint(0, 32, (2, 10))
+    with torch.no_grad():
+        _, tuple_kv = model(x[:, :5], use_cache=True)
+        expected, _ = model(x[:, 5:6], use_cache=True, past_kv=tuple_kv)
+        kv_cache = KVCache(model.config, batch_size=2, max_len=16)
+        # a longer first use leaves stale keys and values past the second prefill
+        _, kv_cache = model(torch.randint(0, 32, (2, 12)), use_cache=True, past_kv=kv_cache)
+        kv_cache.reset()
+        _, kv_cache = model(x[:, :5], use_cache=True, past_kv=kv_cache)
+        pos = torch.tensor([kv_cache.length])
+        logits = model.decode_step(x[:, 5:6], kv_cache.k, kv_cache.v, pos)
+    torch.testing.assert_close(logits, expected)
@@ -0,0 +1,146 @@
+import os
+
+import numpy as np
+import pytest
+
+from bark import render_cache
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(render_cache, "RENDER_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(render_cache, "_cache_bytes", None)
+    monkeypatch.setattr(render_cache, "_model_variant", lambda model_type: model_type)
+    return tmp_path
+
+
+def history_prompt(seed):
+    rng = np.random.default_rng(seed)
+    return {
+        "semantic_prompt": rng.integers(0, 10_000, 20),
+        "coarse_prompt": rng.integers(0, 1024, (2, 30)),
+        "fine_prompt": rng.integers(0, 1024, (8, 30)),
+    }
+
+
+def full_generation(n=10):
+    return {
+        "semantic_prompt": np.arange(n, dtype=np.int64),
+        "coarse_prompt": np.zeros((2, n), dtype=np.int32),
+        "fine_prompt": np.zeros((8, n), dtype=np.int32),
+    }
+
+
+KEY_ARGS = dict(text="Hello there.", history_prompt=None, text_temp=0.7, waveform_temp=0.7, seed=1)
+
+
+def test_render_key_is_stable():
+    assert render_cache.render_key(**KEY_ARGS) == render_cache.render_key(**KEY_ARGS)
+    assert render_cache.render_key(**KEY_ARGS) == render_cache.render_key(
+        **{**KEY_ARGS, "text": "  Hello   there. "}
+    )
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        {"text": "Hello here."},
+        {"history_prompt": history_prompt(0)},
+        {"text_temp": 0.6},
+        {"waveform_temp": 0.6},
+        {"seed": 2},
+    ],
+)
+def test_render_key_changes_with_inputs(change):
+    assert render_cache.render_key(**KEY_ARGS) != render_cache.render_key(**{**KEY_ARGS, **change})
+
+
+def test_render_key_hashes_history_prompt_contents():
+    with_prompt = {**KEY_ARGS, "history_prompt": history_prompt(0)}
+    assert render_cache.render_key(**with_prompt) == render_cache.render_key(
+        **{**KEY_ARGS, "history_prompt": history_prompt(0)}
+    )
+    assert render_cache.render_key(**with_prompt) != render_cache.render_key(
+        **{**KEY_ARGS, "history_prompt": history_prompt(1)}
+    )
+
+
+def test_render_key_changes_with_model_variants(monkeypatch):
+    key = render_cache.render_key(**KEY_ARGS)
+    semantic_key = render_cache.semantic_key("Hello there.", None, 0.7, 1)
+    monkeypatch.setattr(render_cache, "_model_variant", lambda model_type: f"{model_type}_small")
+    assert render_cache.render_key(**KEY_ARGS) != key
+    assert render_cache.semantic_key("Hello there.", None, 0.7, 1) != semantic_key
+
+
+def test_render_key_changes_with_precision(monkeypatch):
+    key = render_cache.render_key(**KEY_ARGS)
+    monkeypatch.setattr(render_cache, "QUANTIZE", "int8")
+    quantized_key = render_cache.render_key(**KEY_ARGS)
+    assert quantized_key != key
+    monkeypatch.setattr(render_cache, "STORAGE_DTYPE", "bfloat16")
+    assert render_cache.render_key(**KEY_ARGS) not in (key, quantized_key)
+
+
+def test_semantic_key_changes_with_temp():
+    assert render_cache.semantic_key("Hello there.", None, 0.7, 1) != render_cache.semantic_key(
+        "Hello there.", None, 0.6, 1
+    )
+
+
+def test_save_and_load_render():
+    key = render_cache.render_key(**KEY_ARGS)
+    assert render_cache.load_render(key) is None
+    audio_arr = np.linspace(-1, 1, 100, dtype=np.float32)
+    render_cache.save_render(key, full_generation(), audio_arr)
+    loaded_generation, loaded_audio = render_cache.load_render(key)
+    np.testing.assert_array_equal(loaded_audio, audio_arr)
+    np.testing.assert_array_equal(loaded_generation["semantic_prompt"], np.arange(10))
+
+
+def test_save_and_load_semantic():
+    key = render_cache.semantic_key("Hello there.", None, 0.7, 1)
+    render_cache.save_semantic(key, np.array([1, 2, 9_999]))
+    loaded = render_cache.load_semantic(key)
+    assert loaded.dtype == np.int64
+    np.testing.assert_array_equal(loaded, [1, 2, 9_999])
+
+
+def test_evict_renders_removes_least_recently_used(cache_dir):
+    keys = [render_cache.render_key(**{**KEY_ARGS, "seed": seed}) for seed in range(3)]
+    for age, key in zip((300, 200, 100), keys):
+        render_cache.save_render(key, full_generation(), np.zeros(40_000, dtype=np.float32))
+        path = render_cache._render_path(key)
+        os.utime(path, (os.path.getmtime(path) - age,) * 2)
+    # a hit makes the oldest entry the most recently used one
+    assert render_cache.load_render(keys[0]) is not None
+    entry_mb = os.path.getsize(render_cache._render_path(keys[0])) / 1024 / 1024
+    render_cache.evict_renders(max_mb=2.5 * entry_mb)
+    assert render_cache.load_render(keys[1]) is None
+    assert render_cache.load_render(keys[0]) is not None
+    assert render_cache.load_render(keys[2]) is not None
+
+
+def test_saves_scan_only_when_over_budget(monkeypatch):
+    scans = []
+    evict_renders = render_cache.evict_renders
+    monkeypatch.setattr(
+        render_cache, "evict_renders", lambda max_mb=None: scans.append(1) or evict_renders(max_mb)
+    )
+    for seed in range(4):
+        key = render_cache.render_key(**{**KEY_ARGS, "seed": seed})
+        render_cache.save_render(key, full_generation(), np.zeros(10, dtype=np.float32))
+    # the first save scans to learn the size, the others fit in the budget
+    assert len(scans) == 1
+    monkeypatch.setattr(render_cache, "RENDER_CACHE_MAX_MB", 0)
+    render_cache.save_render("f" * 64, full_generation(), np.zeros(10, dtype=np.float32))
+    assert len(scans) == 2
+    assert render_cache._list_renders() == []
+
+
+def test_clear_render_cache():
+    key = render_cache.render_key(**KEY_ARGS)
+    render_cache.save_render(key, full_generation(), np.zeros(10, dtype=np.float32))
+    render_cache.clear_render_cache()
+    assert render_cache.load_render(key) is None
+    assert render_cache._cache_bytes == 0
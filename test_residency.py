@@ -0,0 +1,76 @@
+import torch.nn as nn
+
+from bark.residency import ModelResidency, module_bytes
+
+# bytes of an `nn.Linear(4, 4)` in float32, weight and bias
+LINEAR_BYTES = (4 * 4 + 4) * 4
+
+
+def use(residency, key, module):
+    residency.acquire(key, module, "cpu")
+    residency.release(key)
+
+
+def test_module_bytes_counts_shared_tensors_once():
+    linear = nn.Linear(4, 4)
+    assert module_bytes(linear) == LINEAR_BYTES
+    tied = nn.Linear(4, 4, bias=False)
+    tied.weight = linear.weight
+    assert module_bytes(nn.Sequential(linear, tied)) == LINEAR_BYTES
+
+
+def test_default_budget_offloads_after_every_call():
+    residency = ModelResidency()
+    use(residency, "a", nn.Linear(4, 4))
+    stats = residency.stats()
+    assert stats["resident"] == []
+    assert stats["misses"] == 1 and stats["evictions"] == 1
+    assert stats["bytes_moved"] == 2 * LINEAR_BYTES
+
+
+def test_models_in_budget_stay_resident():
+    residency = ModelResidency(budget_bytes=2 * LINEAR_BYTES)
+    a, b = nn.Linear(4, 4), nn.Linear(4, 4)
+    use(residency, "a", a)
+    use(residency, "b", b)
+    use(residency, "a", a)
+    stats = residency.stats()
+    assert stats["resident"] == ["b", "a"]
+    assert stats["hits"] == 1 and stats["misses"] == 2 and stats["evictions"] == 0
+
+
+def test_least_recently_used_model_is_evicted():
+    residency = ModelResidency(budget_bytes=2 * LINEAR_BYTES)
+    a, b, c = nn.Linear(4, 4), nn.Linear(4, 4), nn.Linear(4, 4)
+    use(residency, "a", a)
+    use(residency, "b", b)
+    use(residency, "a", a)
+    use(residency, "c", c)
+    stats = residency.stats()
+    assert stats["resident"] == ["a", "c"]
+    assert stats["evictions"] == 1
+
+
+def test_models_in_use_are_never_evicted():
+    residency = ModelResidency()
+    a, b = nn.Linear(4, 4), nn.Linear(4, 4)
+    residency.acquire("a", a, "cpu")
+    residency.acquire("b", b, "cpu")
+    assert residency.stats()["resident"] == ["a", "b"]
+    residency.release("b")
+    assert residency.stats()["resident"] == ["a"]
+    residency.release("a")
+    assert residency.stats()["resident"] == []
+
+
+def test_forget_and_offload_all():
+    residency = ModelResidency(budget_bytes=2 * LINEAR_BYTES)
+    a, b = nn.Linear(4, 4), nn.Linear(4, 4)
+    use(residency, "a", a)
+    use(residency, "b", b)
+    residency.forget("a")
+    assert residency.stats()["resident"] == ["b"]
+    use(residency, "a", a)
+    assert residency.stats()["misses"] == 3
+    residency.offload_all()
+    assert residency.stats()["resident"] == []
@@ -0,0 +1,57 @@
+import torch
+
+from bark.sampling import Sampler, make_generators
+
+
+def sample_rows(logits, seeds, n_steps=16, **kwargs):
+    sampler = Sampler(generators=make_generators(seeds, "cpu"), **kwargs)
+    return torch.cat([sampler(logits)[0] for _ in range(n_steps)], dim=1)
+
+
+def test_make_generators_without_seeds():
+    assert make_generators(None, "cpu") is None
+
+
+def test_seeded_sampling_is_reproducible():
+    logits = torch.randn(2, 50)
+    assert torch.equal(sample_rows(logits, [1, 2]), sample_rows(logits, [1, 2]))
+    assert not torch.equal(sample_rows(logits, [1, 2]), sample_rows(logits, [3, 4]))
+
+
+def test_seeded_row_does_not_depend_on_the_batch():
+    logits = torch.randn(3, 50)
+    batch = sample_rows(logits, [7, 8, 9])
+    single = sample_rows(logits[1:2], [8])
+    assert torch.equal(batch[1:2], single)
+
+
+def test_seeded_sampling_ignores_global_rng():
+    logits = torch.randn(1, 50)
+    torch.manual_seed(0)
+    first = sample_rows(logits, [5])
+    torch.manual_seed(1)
+    assert torch.equal(sample_rows(logits, [5]), first)
+
+
+def test_top_k_restricts_tokens():
+    logits = torch.arange(50, dtype=torch.float32)[None]
+    tokens = sample_rows(logits, [0], n_steps=64, temp=10.0, top_k=3)
+    assert tokens.min() >= 47
+
+
+def test_top_p_keeps_the_most_likely_token():
+    logits = torch.tensor([[10.0, 0.0, 0.0, 0.0]])
+    tokens = sample_rows(logits, [0], n_steps=32, top_p=0.5)
+    assert torch.all(tokens == 0)
+
+
+def test_per_row_temperature_and_select_rows():
+    logits = torch.randn(3, 50)
+    sampler = Sampler(temp=[0.5, 1.0, 1.5], generators=make_generators([1, 2, 3], "cpu"))
+    sampler(logits)
+    sampler.select_rows(torch.tensor([True, False, True]))
+    assert sampler.temp == [0.5, 1.5]
+    assert len(sampler.generators) == 2
+    item_next, probs = sampler(logits[[0, 2]])
+    assert item_next.shape == (2, 1) and item_next.dtype == torch.int32
+    torch.testing.assert_close(probs.sum(-1), torch.ones(2))